@@ -0,0 +1,50 @@
+# bench/bench_balances.py
+#
+# calculate_user_balances with numpy against the pure-Python loop, for groups of 10, 100 and 1000 members.
+# Every pair of members has a debts row each way, as the debts table stores them.
+# utils imports the Supabase client, so SUPABASE_URL and SUPABASE_KEY must be set; nothing is sent.
+# Usage (from the repository root): python bench/bench_balances.py [members ...]
+
+import os
+import random
+import sys
+import timeit
+import uuid
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bot"))
+
+from utils import calculate_user_balances_numpy, calculate_user_balances_python
+
+
+def generate_debts(members: int, seed: int = 1):
+    """Return debts rows for a group where every pair of members owes one way, like the debts table."""
+    rng = random.Random(seed)
+    uuids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(members)]
+    debts = []
+    for i, user_id in enumerate(uuids):
+        for opp_user_id in uuids[i + 1:]:
+            amount = rng.randint(-99999, 99999) / 100
+            debts.append({'user_id': user_id, 'opp_user_id': opp_user_id, 'amount_owed': amount})
+            debts.append({'user_id': opp_user_id, 'opp_user_id': user_id, 'amount_owed': -amount})
+    return debts
+
+
+def best_ms(fn, debts, runs: int):
+    number = max(1, 20000 // len(debts))
+    return min(timeit.repeat(lambda: fn(debts), number=number, repeat=runs)) / number * 1000
+
+
+def main(sizes=(10, 100, 1000), runs: int = 5):
+    print(f"{'members':>8} {'rows':>9} {'python ms':>10} {'numpy ms':>9} {'speedup':>8}")
+    for members in sizes:
+        debts = generate_debts(members)
+        assert calculate_user_balances_numpy(debts) == calculate_user_balances_python(debts)
+        python_ms = best_ms(calculate_user_balances_python, debts, runs)
+        numpy_ms = best_ms(calculate_user_balances_numpy, debts, runs)
+        print(f"{members:>8} {len(debts):>9} {python_ms:>10.3f} {numpy_ms:>9.3f} {python_ms / numpy_ms:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or (10, 100, 1000))
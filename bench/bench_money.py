@@ -0,0 +1,100 @@
+# bench/bench_money.py
+#
+# Float dollars (how amounts were carried before money.py) against integer cents: correctness and cost.
+# Expenses are split evenly among 2-12 people and stored as DECIMAL(10, 2) debts rows, then netted into balances.
+# utils imports the Supabase client, so SUPABASE_URL and SUPABASE_KEY must be set; nothing is sent.
+# Usage (from the repository root): python bench/bench_money.py [expenses]
+
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bot"))
+
+from money import from_cents, split_evenly, to_cents
+from utils import calculate_user_balances_python
+
+MEMBERS = [f"user-{i}" for i in range(12)]
+
+
+def generate_expenses(count: int, seed: int = 1):
+    """Return (payer, total as entered, [people splitting with the payer]) tuples."""
+    rng = random.Random(seed)
+    expenses = []
+    for _ in range(count):
+        people = rng.sample(MEMBERS, rng.randint(2, 12))
+        expenses.append((people[0], f"{rng.randint(1, 50000) / 100:.2f}", people[1:]))
+    return expenses
+
+
+def debts_float(expenses):
+    # Before money.py: float(total) / people, each share written to a DECIMAL(10, 2) column
+    debts = []
+    for payer, total, others in expenses:
+        share = float(total) / (len(others) + 1)
+        for user in others:
+            debts.append({'user_id': user, 'opp_user_id': payer, 'amount_owed': round(share, 2)})
+    return debts
+
+
+def debts_cents(expenses):
+    debts = []
+    for payer, total, others in expenses:
+        _, *shares = split_evenly(to_cents(total), len(others) + 1)
+        for user, share in zip(others, shares):
+            debts.append({'user_id': user, 'opp_user_id': payer, 'amount_owed': from_cents(share)})
+    return debts
+
+
+def balances_float(debts):
+    # calculate_user_balances before money.py
+    balances = {}
+    for debt in debts:
+        amount_owed = debt['amount_owed']
+        if amount_owed > 0:
+            balances[debt['user_id']] = balances.get(debt['user_id'], 0) - amount_owed
+            balances[debt['opp_user_id']] = balances.get(debt['opp_user_id'], 0) + amount_owed
+    return balances
+
+
+def unaccounted_cents(expenses, share_lists):
+    """Cents per expense by which the shares (payer's included) miss the total, summed over all expenses."""
+    return sum(abs(to_cents(total) - sum(shares)) for (_, total, _), shares in zip(expenses, share_lists))
+
+
+def main(count: int = 20000, runs: int = 5):
+    expenses = generate_expenses(count)
+
+    float_shares = [[to_cents(round(float(total) / (len(others) + 1), 2))] * (len(others) + 1) for _, total, others in expenses]
+    cents_shares = [split_evenly(to_cents(total), len(others) + 1) for _, total, others in expenses]
+    print(f"{count} expenses, {sum(len(shares) for shares in cents_shares)} shares")
+    for label, share_lists in (("float", float_shares), ("cents", cents_shares)):
+        wrong = sum(to_cents(total) != sum(shares) for (_, total, _), shares in zip(expenses, share_lists))
+        print(f"{label} splits not adding up to the total: {wrong} expenses, {unaccounted_cents(expenses, share_lists)} cents in all")
+
+    float_balances = balances_float(debts_float(expenses))
+    cents_balances = calculate_user_balances_python(debts_cents(expenses))
+    print(f"balances sum to zero: float {sum(float_balances.values()):+.2e} dollars, cents {sum(cents_balances.values())} cents")
+    off = sum(round(balance, 2) != balance for balance in float_balances.values())
+    print(f"float balances that are not whole cents: {off} of {len(float_balances)}")
+
+    float_debts, cents_debts = debts_float(expenses), debts_cents(expenses)
+    for label, fn, debts in (
+        ("float balances", balances_float, float_debts),
+        ("cents balances", calculate_user_balances_python, cents_debts),
+    ):
+        seconds = min(timeit.repeat(lambda: fn(debts), number=1, repeat=runs))
+        print(f"{label:<15} {seconds / len(debts) * 1e9:.0f} ns/row (best of {runs})")
+    for label, fn in (
+        ("float split", lambda: [float(total) / (len(others) + 1) for _, total, others in expenses]),
+        ("cents split", lambda: [split_evenly(to_cents(total), len(others) + 1) for _, total, others in expenses]),
+    ):
+        seconds = min(timeit.repeat(fn, number=1, repeat=runs))
+        print(f"{label:<15} {seconds / count * 1e9:.0f} ns/expense (best of {runs})")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
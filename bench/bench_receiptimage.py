@@ -0,0 +1,79 @@
+# bench/bench_receiptimage.py
+#
+# OCR accuracy and latency with and without preprocess_receipt, on synthetic receipt photos:
+# corpus receipts printed on an 80 mm slip, photographed small in the frame, tilted and unevenly lit.
+# Accuracy needs tesseract (TESSERACT_CMD or on PATH); without it only preprocessing is measured.
+# Usage (from the repository root): python bench/bench_receiptimage.py [photos]
+
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+import random
+import pytesseract
+from PIL import Image, ImageDraw, ImageFont
+from receipt_corpus import generate_corpus, score
+from receiptimage import OCR_RECEIPT_WIDTH_MM, OCR_TARGET_DPI, MM_PER_INCH, preprocess_receipt
+from receiptparser import parse_receipt_text
+
+PHOTO_SIZE = (3000, 4000)
+
+
+def render_photo(text, rng):
+    """Print text on a receipt slip and place it, tilted and shaded, in a phone-sized photo."""
+    font = ImageFont.load_default(size=22)
+    lines = text.split("\n")
+    slip = Image.new("L", (560, 40 + 30 * len(lines)), 245)
+    draw = ImageDraw.Draw(slip)
+    for i, line in enumerate(lines):
+        draw.text((30, 20 + 30 * i), line, fill=20, font=font)
+
+    # The slip covers a third to a half of the photo's width
+    width = rng.randint(PHOTO_SIZE[0] // 3, PHOTO_SIZE[0] // 2)
+    slip = slip.resize((width, round(slip.height * width / slip.width)), Image.BICUBIC)
+    slip = slip.rotate(rng.uniform(-5, 5), resample=Image.BICUBIC, expand=True, fillcolor=90)
+
+    photo = Image.new("L", PHOTO_SIZE, 90)
+    photo.paste(slip, ((PHOTO_SIZE[0] - slip.width) // 2, (PHOTO_SIZE[1] - slip.height) // 2))
+    # Light falls off from left to right
+    shade = Image.linear_gradient("L").rotate(90).resize(PHOTO_SIZE).point(lambda value: 255 - value // 3)
+    return Image.composite(photo, Image.new("L", PHOTO_SIZE, 0), shade).convert("RGB"), width
+
+
+def main(count: int = 10):
+    rng = random.Random(1)
+    corpus = generate_corpus(count)
+    photos = [render_photo(text, rng) for text, _ in corpus]
+
+    started = time.perf_counter()
+    prepared = [preprocess_receipt(photo) for photo, _ in photos]
+    preprocess_ms = (time.perf_counter() - started) / count * 1000
+    receipt_inches = OCR_RECEIPT_WIDTH_MM / MM_PER_INCH
+    effective_dpi = sum(image.width for image in prepared) / count / receipt_inches
+    print(f"{count} photos of {PHOTO_SIZE[0]}x{PHOTO_SIZE[1]}, slip {sum(width for _, width in photos) // count} px wide on average")
+    print(f"preprocessing: {preprocess_ms:.0f} ms/photo, output {effective_dpi:.0f} dpi across the slip (target {OCR_TARGET_DPI})")
+
+    tesseract = os.getenv("TESSERACT_CMD") or shutil.which("tesseract")
+    if not tesseract:
+        print("tesseract not found, skipping OCR accuracy")
+        return
+    pytesseract.pytesseract.tesseract_cmd = tesseract
+
+    for label, images, config in (
+        ("raw photo", [photo for photo, _ in photos], ""),
+        ("preprocessed", prepared, f"--dpi {OCR_TARGET_DPI}"),
+    ):
+        texts = {}
+        started = time.perf_counter()
+        for (text, _), image in zip(corpus, images):
+            texts[text] = pytesseract.image_to_string(image, config=config)
+        ocr_ms = (time.perf_counter() - started) / count * 1000
+        accuracy, _ = score(lambda text: parse_receipt_text(texts[text]), corpus)
+        print(f"{label:<13} accuracy {accuracy:.1%}, tesseract {ocr_ms:.0f} ms/photo")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
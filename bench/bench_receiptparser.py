@@ -0,0 +1,30 @@
+# bench/bench_receiptparser.py
+#
+# Accuracy and speed of parse_receipt_text over a synthetic receipt corpus.
+# Usage (from the repository root): python bench/bench_receiptparser.py [receipts]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+from receipt_corpus import generate_corpus, score
+from receiptparser import parse_receipt_text
+
+
+def main(count: int = 500):
+    corpus = generate_corpus(count)
+    accuracy, by_layout = score(parse_receipt_text, corpus)
+    print(f"{count} receipts, {sum(len(expected) for _, expected in corpus)} items")
+    print(f"accuracy: {accuracy:.1%}")
+    for layout, layout_accuracy in by_layout.items():
+        print(f"  {layout:<14} {layout_accuracy:.1%}")
+
+    runs = 5
+    seconds = min(timeit.repeat(lambda: [parse_receipt_text(text) for text, _ in corpus], number=1, repeat=runs))
+    print(f"time: {seconds / count * 1e6:.0f} us/receipt (best of {runs})")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,89 @@
+# bench/receipt_corpus.py
+
+import random
+
+# Synthetic receipt text in the layouts parse_receipt_text is expected to read.
+# Shared by bench_receiptparser.py and tests/test_receiptparser.py.
+
+NAMES = ["Chicken Rice", "Iced Latte", "Kaya Toast", "Nasi Lemak", "Teh Peng", "Fish Soup",
+         "Coke 330ml", "Char Kway Teow", "Item number 10", "Mee Goreng"]
+
+LAYOUTS = [
+    "plain",          # "Kaya Toast    3.20"
+    "dot_leaders",    # "Kaya Toast ....... 3.20"
+    "dash",           # "Kaya Toast - 3.20"
+    "trailing_qty",   # "Kaya Toast x2 6.40"
+    "unit_price",     # "Kaya Toast 2 @ 3.20 each = 6.40"
+    "columns",        # "Kaya Toast   2   3.20   6.40"
+    "leading_qty",    # "2 x Kaya Toast   $6.40"
+    "quantity_line",  # "Kaya Toast" then "  2 x 3.20      6.40"
+    "thousands",      # "Kaya Toast    1,234.56" or "Kaya Toast    1.234,56"
+]
+
+
+def _amount(rng):
+    return rng.randint(100, 9999) / 100
+
+
+def _grouped(amount, rng):
+    # 1,234.56 or the European 1.234,56
+    text = f"{amount:,.2f}"
+    if rng.random() < 0.5:
+        text = text.replace(",", "_").replace(".", ",").replace("_", ".")
+    return text
+
+
+def generate_receipt(rng):
+    """Return (receipt text, [(item name, amount, layout)]) for one random receipt."""
+    lines = ["KOPITIAM PTE LTD", "Table 12", "Date: 12/03/2024", "Server: Ah Meng"]
+    expected = []
+    for _ in range(rng.randint(3, 12)):
+        name = rng.choice(NAMES)
+        quantity = rng.randint(1, 4)
+        unit = _amount(rng)
+        total = round(quantity * unit, 2)
+        layout = rng.choice(LAYOUTS)
+        if layout == "plain":
+            lines.append(f"{name}    {total:.2f}")
+        elif layout == "dot_leaders":
+            lines.append(f"{name} ....... {total:.2f}")
+        elif layout == "dash":
+            lines.append(f"{name} - {total:.2f}")
+        elif layout == "trailing_qty":
+            lines.append(f"{name} x{quantity} {total:.2f}")
+        elif layout == "unit_price":
+            lines.append(f"{name} {quantity} @ {unit:.2f} each = {total:.2f}")
+        elif layout == "columns":
+            lines.append(f"{name}   {quantity}   {unit:.2f}   {total:.2f}")
+        elif layout == "leading_qty":
+            lines.append(f"{quantity} x {name}   ${total:.2f}")
+        elif layout == "quantity_line":
+            lines += [name, f"  {quantity} x {unit:.2f}      {total:.2f}"]
+        else:
+            total = rng.randint(100000, 999999) / 100
+            lines.append(f"{name}    {_grouped(total, rng)}")
+        expected.append((name, total, layout))
+    subtotal = sum(total for _, total, _ in expected)
+    lines += [f"SUBTOTAL {subtotal:.2f}", f"GST 9% {subtotal * 0.09:.2f}", f"TOTAL {subtotal * 1.09:.2f}", "Thank you!"]
+    return "\n".join(lines), expected
+
+
+def generate_corpus(count: int = 500, seed: int = 1):
+    rng = random.Random(seed)
+    return [generate_receipt(rng) for _ in range(count)]
+
+
+def score(parse, corpus):
+    """Return (overall accuracy, {layout: accuracy}) of parse over corpus, counting exact (name, amount) matches."""
+    hits = {layout: [0, 0] for layout in LAYOUTS}
+    for text, expected in corpus:
+        try:
+            parsed = {(item['item'], round(item['amount'], 2)) for item in parse(text)}
+        except Exception:
+            parsed = set()
+        for name, total, layout in expected:
+            hits[layout][0] += (name, total) in parsed
+            hits[layout][1] += 1
+    found = sum(hit for hit, _ in hits.values())
+    total = sum(count for _, count in hits.values())
+    return found / total, {layout: hit / count for layout, (hit, count) in hits.items() if count}
@@ -0,0 +1,89 @@
+# bot/cache.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 60))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 2048))
+# Snapshots are keyed by group version, so the TTL only bounds memory and can outlive a daily reminder run
+DEBT_SNAPSHOT_TTL_SECONDS = float(os.getenv("DEBT_SNAPSHOT_TTL_SECONDS", 2 * 24 * 60 * 60))
+# Reminder runs visit every reminder group in the same order, so an LRU smaller than that set never hits.
+# Keep it above the number of reminder groups, with room for the superseded versions of changed groups.
+DEBT_SNAPSHOT_MAX_ENTRIES = int(os.getenv("DEBT_SNAPSHOT_MAX_ENTRIES", 20000))
+# Long enough to cover re-uploading a receipt after a failed tagging round
+RECEIPT_CACHE_TTL_SECONDS = float(os.getenv("RECEIPT_CACHE_TTL_SECONDS", 60 * 60))
+RECEIPT_CACHE_MAX_ENTRIES = int(os.getenv("RECEIPT_CACHE_MAX_ENTRIES", 256))
+
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire after ttl seconds, evicting the least recently used beyond maxsize."""
+
+    def __init__(self, name: str, maxsize: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+
+
+# Raw database rows are cached rather than objects, so callers can mutate what they get back
+group_by_chat_cache = TTLCache("group_by_chat")  # chat_id -> groups row
+members_by_group_cache = TTLCache("members_by_group")  # group_id -> get_group_members rows
+member_uuids_by_group_cache = TTLCache("member_uuids_by_group")  # group_id -> frozenset of member uuids
+user_by_telegram_id_cache = TTLCache("user_by_telegram_id")  # Telegram user_id -> users row
+receipt_items_cache = TTLCache("receipt_items", maxsize=RECEIPT_CACHE_MAX_ENTRIES, ttl=RECEIPT_CACHE_TTL_SECONDS)  # (pipeline, sha256 of image) -> parsed items
+debt_snapshot_cache = TTLCache("debt_snapshot", maxsize=DEBT_SNAPSHOT_MAX_ENTRIES, ttl=DEBT_SNAPSHOT_TTL_SECONDS)  # (group_id, version) -> (balances, simplified_debts, rendered_string)
+
+
+def cache_stats():
+    """Return hit and miss counters for every cache."""
+    caches = [group_by_chat_cache, members_by_group_cache, member_uuids_by_group_cache, user_by_telegram_id_cache, debt_snapshot_cache, receipt_items_cache]
+    return {cache.name: cache.stats() for cache in caches}
@@ -2,12 +2,24 @@
 
 from datetime import datetime
 from client import supa
+from repository import repo
+from cache import group_by_chat_cache, members_by_group_cache, member_uuids_by_group_cache, user_by_telegram_id_cache, debt_snapshot_cache
+from ledger import BALANCE_LEDGER_ENABLED, PAGE_SIZE, delete_member_balance
+from postgrest.exceptions import APIError
 import uuid
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# PostgREST answers PGRST202 (or a bare 404 from older versions) when an RPC is not installed.
+# The client sets code to the integer status when the response is not JSON, so codes are compared as strings.
+MISSING_RPC_CODES = ("PGRST202", "404")
+
+def is_missing_rpc(error: Exception):
+    """Check if a Supabase error means the called RPC does not exist in the database."""
+    return isinstance(error, APIError) and str(error.code) in MISSING_RPC_CODES
+
 class User:
     def __init__(self, user_id: int, username: str, user_uuid: str = None, currency: str = "SGD"):
         self.user_id = user_id  # This is the Telegram user ID (integer)
@@ -25,20 +37,30 @@ class User:
             "currency": self.currency,
             "created_at": self.created_at.isoformat(timespec="microseconds"), # Seralise datetime
         }
-        return supa.table('users').insert(user_data).execute()
+        response = supa.table('users').insert(user_data).execute()
+        user_by_telegram_id_cache.invalidate(self.user_id)
+        return response
     
     def update_username(self, new_username: str):
         """Update the username of the user."""
         self.username = new_username
         supa.table('users').update({"username": new_username}).eq("uuid", self.uuid).execute()
+        user_by_telegram_id_cache.invalidate(self.user_id)
+        # The user may appear in any number of cached member lists and rendered debt snapshots
+        members_by_group_cache.clear()
+        debt_snapshot_cache.clear()
 
     @staticmethod
     def fetch_from_db_by_user_id(user_id: int):
         """Fetch a user from the database by Telegram user_id and create a User instance."""
         try:
-            # Fetch user by user_id (Telegram ID)
-            response = supa.table('users').select("*").eq("user_id", user_id).single().execute()
-            user_data = response.data
+            user_data = user_by_telegram_id_cache.get(user_id)
+            if user_data is None:
+                # Fetch user by user_id (Telegram ID)
+                response = supa.table('users').select("*").eq("user_id", user_id).single().execute()
+                user_data = response.data
+                if user_data:
+                    user_by_telegram_id_cache.set(user_id, user_data)
             if user_data:
                 return User(user_id=user_data['user_id'], username=user_data['username'], user_uuid=user_data['uuid'], currency=user_data['currency'])
         except Exception as e:
@@ -109,8 +131,36 @@ class User:
             print(f"Error fetching users by username: {e}")
             return {}
 
+class GroupRoster:
+    """Members of a group indexed by uuid, username and Telegram user id."""
+
+    def __init__(self, members: list):
+        self.members = members
+        self.by_uuid = {member.uuid: member for member in members}
+        self.by_username = {member.username: member for member in members}
+        self.by_user_id = {member.user_id: member for member in members}
+
+    @staticmethod
+    def from_rows(member_rows):
+        """Build a roster from get_group_members rows."""
+        members = [
+            User(
+                user_id=member['user_id'],
+                username=member['username'],
+                user_uuid=member['uuid'],
+                currency=member['currency']
+            ) for member in member_rows or []
+        ]
+        return GroupRoster(members)
+
+    def __len__(self):
+        return len(self.members)
+
 class Group:
-    def __init__(self, group_name: str, created_by: User, chat_id: int, group_id: str = None, reminders = False, message_id = None):
+    # Cleared the first time delete_group_cascade turns out not to be installed
+    cascade_rpc_installed = True
+
+    def __init__(self, group_name: str, created_by: User, chat_id: int, group_id: str = None, reminders = False, message_id = None, version = None):
         self.group_id = group_id or str(uuid.uuid4())  # Generate UUID if not provided
         self.group_name = group_name
         self.created_by = created_by
@@ -118,17 +168,50 @@ class Group:
         self.created_at = datetime.now()
         self.reminders = reminders
         self.message_id = message_id  # Initialize with provided message_id or None
+        self.version = version  # groups.version, bumped by the database on every debt-affecting write
+        self._roster = None  # GroupRoster, fetched lazily by fetch_roster()
 
         # Add logging to check UUID generation and its type
         logging.info(f"Generated group_id: {self.group_id}")
         logging.info(f"Type of group_id: {type(self.group_id)}")
 
     def check_user_in_group(self, user: User):
-        existing_user_in_group = supa.table('group_members').select('*').eq('user_uuid', user.uuid).eq('group_id', self.group_id).execute()
-        if existing_user_in_group.data:
-            return True
-        else:
-            return False
+        """
+        Check if a user is a member of the group.
+
+        Answered from the loaded roster or the cached member uuids when either is
+        available, otherwise with an existence query that returns at most one uuid.
+        """
+        if self._roster is not None:
+            return user.uuid in self._roster.by_uuid
+
+        member_uuids = self._cached_member_uuids()
+        if member_uuids is not None:
+            return user.uuid in member_uuids
+
+        # Not head=True: the postgrest client reports a count of 0 for every HEAD response
+        response = supa.table('group_members').select('user_uuid').eq('group_id', self.group_id).eq('user_uuid', user.uuid).limit(1).execute()
+        return bool(response.data)
+
+    def _cached_member_uuids(self):
+        member_uuids = member_uuids_by_group_cache.get(self.group_id)
+        if member_uuids is None:
+            member_rows = members_by_group_cache.get(self.group_id)
+            if member_rows is not None:
+                member_uuids = frozenset(row['uuid'] for row in member_rows)
+                member_uuids_by_group_cache.set(self.group_id, member_uuids)
+        return member_uuids
+
+    def _update_member_uuids(self, added: str = None, removed: str = None):
+        # Keeps the cached set current after the bot adds or removes a member, so the next check needs no query
+        member_uuids = member_uuids_by_group_cache.get(self.group_id)
+        if member_uuids is None:
+            return
+        if added:
+            member_uuids = member_uuids | {added}
+        if removed:
+            member_uuids = member_uuids - {removed}
+        member_uuids_by_group_cache.set(self.group_id, member_uuids)
 
     def save_to_db(self):
         """Save the group to the database."""
@@ -140,10 +223,14 @@ class Group:
             "created_at": self.created_at.isoformat(timespec="microseconds"),  # Serialize datetime to ISO 8601 string,
             "message_id": self.message_id
         }
-        return supa.table('groups').upsert(group_data, on_conflict='group_id').execute()
+        response = supa.table('groups').upsert(group_data, on_conflict='group_id').execute()
+        group_by_chat_cache.invalidate(self.chat_id)
+        return response
 
     def add_member(self, user: User):
         """Add a user to the group and save to database."""
+        # Loading the roster first lets the membership check below skip its query
+        self.fetch_roster()
         if not self.check_user_in_group(user):
             member_data = {
                 "group_id": self.group_id,
@@ -179,49 +266,95 @@ class Group:
             if debt_entries:
                 supa.table('debts').insert(debt_entries).execute()
                 
-            return supa.table('group_members').insert(member_data).execute()
+            response = supa.table('group_members').insert(member_data).execute()
+            members_by_group_cache.invalidate(self.group_id)
+            self._update_member_uuids(added=user.uuid)
+            self._roster = None
+            self.mark_changed()
+            return response
+
+    def mark_changed(self):
+        """
+        Forget the group's version after the bot changes its expenses, settlements or members.
+
+        The database bumps groups.version itself; this only drops the copies held by
+        this instance and the group cache so the next lookup reads the new version.
+        """
+        self.version = None
+        group_by_chat_cache.invalidate(self.chat_id)
+
+    def _fetch_member_rows(self):
+        """Fetch the get_group_members rows for the group, served from cache while fresh."""
+        member_rows = members_by_group_cache.get(self.group_id)
+        if member_rows is None:
+            member_rows = repo.run(repo.fetch_group_members(self.group_id))
+            members_by_group_cache.set(self.group_id, member_rows)
+            member_uuids_by_group_cache.set(self.group_id, frozenset(row['uuid'] for row in member_rows or []))
+        return member_rows
+
+    def fetch_roster(self):
+        """
+        Fetch the group's members as a GroupRoster with a single get_group_members call.
+
+        The roster is kept on the Group instance, so everything handling the same
+        update shares one fetch.
+        """
+        if self._roster is None:
+            try:
+                self._roster = GroupRoster.from_rows(self._fetch_member_rows())
+            except Exception as e:
+                logging.error(f"Error fetching members for group {self.group_id}: {e}")
+                return GroupRoster([])
+        return self._roster
 
     def fetch_all_members(self):
         """Fetch all members of the group using a single database call."""
-        try:
-            # Call the RPC function to get all members in one query
-            response = supa.rpc('get_group_members', {'group_id_param': self.group_id}).execute()
-            
-            if response.data:
-                # Create User objects from the response data
-                members = [
-                    User(
-                        user_id=member['user_id'],
-                        username=member['username'],
-                        user_uuid=member['uuid'],
-                        currency=member['currency']
-                    ) for member in response.data
-                ]
-                return members
-            return []
-            
-        except Exception as e:
-            logging.error(f"Error fetching members for group {self.group_id}: {e}")
-            return []
+        return self.fetch_roster().members
 
     def fetch_debts_by_group(self):
         """Fetch all splits from the debts table for a given group."""
-        response = supa.table('debts').select('*').eq('group_id', self.group_id).execute()
-        return response.data
+        return repo.run(repo.fetch_debts_by_group(self.group_id))
     
     def delete_from_db(self):
-        """Delete the group and related records (members, expenses, splits) from the database."""
-        # Delete related data first (group members, expenses, etc.)
-        supa.table('group_members').delete().eq('group_id', self.group_id).execute()
-        supa.table('expenses').delete().eq('group_id', self.group_id).execute()
-        supa.table('groups').delete().eq('group_id', self.group_id).execute()
+        """
+        Delete the group and all of its rows (members, expenses, splits, settlements, debts, balances).
+
+        Everything is removed in one transaction by the delete_group_cascade RPC. If the
+        RPC is not installed, falls back to deleting each table in turn.
+        """
+        if Group.cascade_rpc_installed:
+            try:
+                supa.rpc("delete_group_cascade", {"group_id_param": self.group_id}).execute()
+            except Exception as e:
+                if not is_missing_rpc(e):
+                    raise
+                logging.warning("delete_group_cascade RPC is not installed, deleting group rows in separate calls")
+                Group.cascade_rpc_installed = False
+
+        if not Group.cascade_rpc_installed:
+            # Delete related data first (debts, settlements, expenses, members)
+            supa.table('debts').delete().eq('group_id', self.group_id).execute()
+            supa.table('settlements').delete().eq('group_id', self.group_id).execute()
+            if BALANCE_LEDGER_ENABLED:
+                supa.table('balances').delete().eq('group_id', self.group_id).execute()
+            supa.table('expenses').delete().eq('group_id', self.group_id).execute()  # expense_splits cascade
+            supa.table('group_members').delete().eq('group_id', self.group_id).execute()
+            supa.table('groups').delete().eq('group_id', self.group_id).execute()
+        group_by_chat_cache.invalidate(self.chat_id)
+        members_by_group_cache.invalidate(self.group_id)
+        member_uuids_by_group_cache.invalidate(self.group_id)
     
     def remove_member(self, user: User):
         """Delete user from the group_members table in database."""
         # Delete related data first (group members, expenses, etc.)
-        supa.table('group_members').delete().eq('user_uuid', user.uuid).execute()
-        supa.table('debts').delete().eq('user_id', user.uuid).execute()
-        supa.table('debts').delete().eq('opp_user_id', user.uuid).execute()
+        supa.table('group_members').delete().eq('group_id', self.group_id).eq('user_uuid', user.uuid).execute()
+        supa.table('debts').delete().eq('group_id', self.group_id).eq('user_id', user.uuid).execute()
+        supa.table('debts').delete().eq('group_id', self.group_id).eq('opp_user_id', user.uuid).execute()
+        delete_member_balance(self.group_id, user.uuid)
+        members_by_group_cache.invalidate(self.group_id)
+        self._update_member_uuids(removed=user.uuid)
+        self._roster = None
+        self.mark_changed()
 
     def update_debt(self, user_id: str, opp_user_id: str, amount_owed: float):
         """Update the debt amount between two users in the group."""
@@ -278,6 +411,7 @@ class Group:
                 Expense.add_debts_bulk(debt_updates)
                 
             supa.table('expenses').delete().eq('expense_id', expense_entry['expense_id']).execute()
+            self.mark_changed()
         else:
             raise Exception("Nothing to delete! There are no expenses recorded in this group.")
         
@@ -309,6 +443,7 @@ class Group:
                 Expense.add_debts_bulk(debt_updates)
                 
             supa.table('settlements').delete().eq('settlement_id', settlement_entry['settlement_id']).execute()
+            self.mark_changed()
         else:
             raise Exception("Nothing to delete! There are no settlements recorded in this group.")
 
@@ -316,15 +451,23 @@ class Group:
     def get_groups_with_reminders_on():
         """
         Fetch all groups that have reminders enabled and return them as Group objects.
+        Paged, since PostgREST returns at most 1000 rows per request.
         Returns:
             list[Group]: List of Group objects with reminders enabled
         """
         try:
-            response = supa.table('groups').select("*").eq("reminders", True).execute()
+            rows = []
+            start = 0
+            while True:
+                response = supa.table('groups').select("*").eq("reminders", True).order("group_id").range(start, start + PAGE_SIZE - 1).execute()
+                rows.extend(response.data)
+                if len(response.data) < PAGE_SIZE:
+                    break
+                start += PAGE_SIZE
             groups = []
             
-            if response.data:
-                for group_data in response.data:
+            if rows:
+                for group_data in rows:
                     # Create temporary User object for created_by
                     created_by_user = User(
                         user_id=0,  # placeholder
@@ -339,7 +482,8 @@ class Group:
                         created_by=created_by_user,
                         chat_id=group_data['chat_id'],
                         reminders=True,
-                        message_id=group_data.get('message_id')  # Load message_id from database
+                        message_id=group_data.get('message_id'),  # Load message_id from database
+                        version=group_data.get('version')
                     )
                     groups.append(group)
                     
@@ -357,64 +501,30 @@ class Group:
                 supa.table("groups").update({"reminders": True}).eq("group_id", self.group_id).execute()
                 self.reminders = True
                 print("Reminders turned on for {self.group_id}.")
+            group_by_chat_cache.invalidate(self.chat_id)
         except Exception as e: 
             print(f"Error toggling reminders for group {self.group_id}: {str(e)}")
 
     @staticmethod
     def fetch_group_members_dict(group):
-        """Fetch all members of the group using a single database call."""
-        try:
-            # Call the RPC function to get all members in one query
-            response = supa.rpc('get_group_members', {'group_id_param': group.group_id}).execute()
-            user_id_to_user = {}
-            
-            if response.data:
-                # Create User objects from the response data
-                for member in response.data:
-                    user_id_to_user[member['uuid']] = User(
-                        user_id=member['user_id'],
-                        username=member['username'],
-                        user_uuid=member['uuid'],
-                        currency=member['currency']
-                    )
-             
-            return user_id_to_user
-            
-        except Exception as e:
-            logging.error(f"Error fetching members for group {group.group_id}: {e}")
-            return {}
+        """Fetch all members of the group keyed by uuid."""
+        return group.fetch_roster().by_uuid
         
     @staticmethod
     def fetch_group_members_usernames_dict(group):
-        """Fetch all members of the group using a single database call."""
-        try:
-            # Call the RPC function to get all members in one query
-            response = supa.rpc('get_group_members', {'group_id_param': group.group_id}).execute()
-            username_to_user = {}
-            
-            if response.data:
-                # Create User objects from the response data
-                for member in response.data:
-                    username_to_user[member['username']] = User(
-                        user_id=member['user_id'],
-                        username=member['username'],
-                        user_uuid=member['uuid'],
-                        currency=member['currency']
-                    )
-                return username_to_user
-                
-            return {}
-            
-        except Exception as e:
-            logging.error(f"Error fetching members for group {group.group_id}: {e}")
-            return {}
+        """Fetch all members of the group keyed by username."""
+        return group.fetch_roster().by_username
     
     @staticmethod
     def fetch_from_db_by_chat(chat_id: int):
         """Fetch a group from the database using the chat_id."""
         try:
-            response = supa.table('groups').select("*").eq("chat_id", chat_id).maybe_single().execute()
-            group_data = response.data
+            group_data = group_by_chat_cache.get(chat_id)
+            if group_data is None:
+                response = supa.table('groups').select("*").eq("chat_id", chat_id).maybe_single().execute()
+                group_data = response.data
+                if group_data:
+                    group_by_chat_cache.set(chat_id, group_data)
             if group_data:
                 created_by_user = User(user_id=0, username="deleted_user", user_uuid=group_data['created_by'])
                 group_instance = Group(
@@ -423,7 +533,8 @@ class Group:
                     created_by=created_by_user,
                     chat_id=group_data['chat_id'],
                     reminders=group_data['reminders'],
-                    message_id=group_data.get('message_id')  
+                    message_id=group_data.get('message_id'),
+                    version=group_data.get('version')
                 )
                 return group_instance
             else:
@@ -442,9 +553,12 @@ class Expense:
         self.description = description
         self.created_at = created_at or datetime.now()
 
-    def save_to_db(self):
-        """Save the expense to the database."""
-        expense_data = {
+    # Cleared the first time commit_expense turns out not to be installed, so later commits skip straight to the fallback
+    commit_rpc_installed = True
+
+    def to_row(self):
+        """Return the expense as an expenses table row."""
+        return {
             "expense_id": self.expense_id,
             "group_id": self.group.group_id,
             "paid_by": self.paid_by.uuid,
@@ -452,7 +566,45 @@ class Expense:
             "description": self.description,
             "created_at": self.created_at.isoformat(timespec="microseconds")
         }
-        return supa.table('expenses').insert(expense_data).execute()
+
+    def save_to_db(self):
+        """Save the expense to the database."""
+        response = supa.table('expenses').insert(self.to_row()).execute()
+        self.group.mark_changed()
+        return response
+
+    def commit(self, splits_to_add, debt_updates):
+        """
+        Save the expense together with its splits and debt updates.
+
+        Everything is written in one transaction by the commit_expense RPC, so a failure
+        cannot leave debts out of step with splits. If the RPC is not installed, falls
+        back to saving the expense, debts and splits in separate calls.
+        """
+        for debt in debt_updates:
+            if debt['increment_value'] >= 10**8:
+                raise ValueError(f"Amount owed must be less than {10**8}.")
+
+        if Expense.commit_rpc_installed:
+            try:
+                supa.rpc("commit_expense", {
+                    "expense": self.to_row(),
+                    "splits": splits_to_add,
+                    "debt_updates": debt_updates
+                }).execute()
+                self.group.mark_changed()
+                return
+            except Exception as e:
+                if not is_missing_rpc(e):
+                    raise
+                logging.warning("commit_expense RPC is not installed, saving expenses in separate calls")
+                Expense.commit_rpc_installed = False
+
+        self.save_to_db()
+        if debt_updates:
+            Expense.add_debts_bulk(debt_updates)
+        if splits_to_add:
+            Expense.add_splits_bulk(splits_to_add)
 
     def add_debt(self, user: User, amount_owed: float):
         """Add debt for a user."""
@@ -505,13 +657,15 @@ class Expense:
     @staticmethod
     def fetch_expenses_by_group(group: Group, group_members_dict = None):
         """Fetch all expenses for a group."""
+        # Start the expenses read first so it runs alongside the member lookup
+        expense_rows_future = repo.submit(repo.fetch_expenses_by_group(group.group_id))
         if not group_members_dict:
             group_members_dict = Group.fetch_group_members_dict(group)
             
-        response = supa.table('expenses').select("*").eq('group_id', group.group_id).execute()
+        expense_rows = expense_rows_future.result()
         expenses = []
-        if response.data:
-            for exp in response.data:
+        if expense_rows:
+            for exp in expense_rows:
 
                 paid_by_user = group_members_dict[exp['paid_by']]
 
@@ -560,7 +714,9 @@ class Settlement:
             "group_id": self.group.group_id,
             "created_at": self.created_at.isoformat(timespec="microseconds")
         }
-        return supa.table('settlements').insert(settlement_data).execute()
+        response = supa.table('settlements').insert(settlement_data).execute()
+        self.group.mark_changed()
+        return response
     
     @staticmethod
     def add_settlement_bulk(settlements_to_add):
@@ -584,6 +740,9 @@ class Settlement:
 
         response = supa.table('settlements').insert(settlements_data).execute()
 
+        for settlement in settlements_to_add:
+            settlement.group.mark_changed()
+
          # Check response
         if "error" in response:
             print("Error adding bulk settlement records:", response["error"])
@@ -594,11 +753,13 @@ class Settlement:
     @staticmethod
     def fetch_settlements_by_group(group: Group):
         """Fetch all settlements for a group."""
-        response = supa.table('settlements').select("*").eq('group_id', group.group_id).execute()
-        settlements = []
+        # Start the settlements read first so it runs alongside the member lookup
+        settlement_rows_future = repo.submit(repo.fetch_settlements_by_group(group.group_id))
         group_members_dict = Group.fetch_group_members_dict(group)
-        if response.data:
-            for settlement in response.data:
+        settlement_rows = settlement_rows_future.result()
+        settlements = []
+        if settlement_rows:
+            for settlement in settlement_rows:
                 from_user = group_members_dict[settlement['from_user']]
                 to_user = group_members_dict[settlement['to_user']]
                 settlements.append(Settlement(
@@ -0,0 +1,130 @@
+# bot/debtsimplifier.py
+
+import heapq
+import logging
+import time
+
+# Balances map a user uuid to integer cents: positive is owed money, negative owes money.
+# Every strategy returns a list of (debtor_id, creditor_id, amount) transfers.
+
+
+class GreedyHeapSimplifier:
+    """Repeatedly settle the largest debtor against the largest creditor. O(n log n)."""
+
+    def simplify(self, balances):
+        # Max-heaps via negated amounts, ties broken by uuid so results are deterministic
+        creditors = [(-balance, user_id) for user_id, balance in balances.items() if balance > 0]
+        debtors = [(balance, user_id) for user_id, balance in balances.items() if balance < 0]
+        heapq.heapify(creditors)
+        heapq.heapify(debtors)
+
+        simplified_debts = []
+        while creditors and debtors:
+            negated_credit, creditor_id = heapq.heappop(creditors)
+            negated_debt, debtor_id = heapq.heappop(debtors)
+            credit_amount, debt_amount = -negated_credit, -negated_debt
+
+            amount = min(credit_amount, debt_amount)
+            simplified_debts.append((debtor_id, creditor_id, amount))
+
+            # Whoever is not fully settled goes back on their heap
+            if credit_amount > amount:
+                heapq.heappush(creditors, (amount - credit_amount, creditor_id))
+            if debt_amount > amount:
+                heapq.heappush(debtors, (amount - debt_amount, debtor_id))
+
+        return simplified_debts
+
+
+class TimeBudgetExceeded(Exception):
+    pass
+
+
+class ExactSimplifier:
+    """
+    Find the fewest possible transfers.
+
+    n people with non-zero balances need n - k transfers, where k is the largest
+    number of disjoint zero-sum groups they can be split into. k is found by a
+    dynamic programme over all 2^n subsets. Each group is then settled with
+    the greedy matcher, which needs exactly one transfer fewer than the group size.
+    """
+
+    def __init__(self, time_budget: float = None):
+        self.time_budget = time_budget
+        self._greedy = GreedyHeapSimplifier()
+
+    def simplify(self, balances):
+        people = [(user_id, balance) for user_id, balance in sorted(balances.items()) if balance != 0]
+        amounts = [balance for _, balance in people]
+        if sum(amounts) != 0:
+            # Inconsistent balances have no exact zero-sum partition
+            return self._greedy.simplify(balances)
+
+        simplified_debts = []
+        for group in self._zero_sum_groups(amounts):
+            simplified_debts.extend(self._greedy.simplify({people[i][0]: people[i][1] for i in group}))
+        return simplified_debts
+
+    def _zero_sum_groups(self, amounts):
+        n = len(amounts)
+        full = (1 << n) - 1
+        deadline = time.monotonic() + self.time_budget if self.time_budget is not None else None
+
+        sums = [0] * (full + 1)
+        # groups[mask]: the most zero-sum groups among the prefixes of the best ordering of mask
+        groups = [0] * (full + 1)
+        for mask in range(1, full + 1):
+            if deadline is not None and mask & 1023 == 0 and time.monotonic() > deadline:
+                raise TimeBudgetExceeded()
+            lowest = mask & -mask
+            sums[mask] = sums[mask ^ lowest] + amounts[lowest.bit_length() - 1]
+            best = 0
+            remaining = mask
+            while remaining:
+                bit = remaining & -remaining
+                remaining ^= bit
+                if groups[mask ^ bit] > best:
+                    best = groups[mask ^ bit]
+            groups[mask] = best + (1 if sums[mask] == 0 else 0)
+
+        # Walk the best ordering back down; each zero-sum prefix closes a group
+        result = []
+        mask = full
+        current = []
+        while mask:
+            bit = max(_bits(mask), key=lambda b: groups[mask ^ b])
+            current.append(bit.bit_length() - 1)
+            mask ^= bit
+            if sums[mask] == 0:
+                result.append(current)
+                current = []
+        return result
+
+
+def _bits(mask):
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+
+class AutoSimplifier:
+    """Use the exact solver for small groups and the greedy matcher otherwise or when the exact solver runs out of time."""
+
+    def __init__(self, exact_max_participants: int = 12, time_budget: float = 0.05):
+        self.exact_max_participants = exact_max_participants
+        self._exact = ExactSimplifier(time_budget=time_budget)
+        self._greedy = GreedyHeapSimplifier()
+
+    def simplify(self, balances):
+        participants = sum(1 for balance in balances.values() if balance != 0)
+        if participants <= self.exact_max_participants:
+            try:
+                return self._exact.simplify(balances)
+            except TimeBudgetExceeded:
+                logging.warning(f"Exact debt simplification exceeded its time budget for {participants} participants, using greedy")
+        return self._greedy.simplify(balances)
+
+
+default_simplifier = AutoSimplifier()
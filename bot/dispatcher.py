@@ -0,0 +1,164 @@
+# bot/dispatcher.py
+
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_update_chat_id(update):
+    """Return the chat id an update belongs to, or None if it has no chat."""
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message:
+        return message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    if update.my_chat_member:
+        return update.my_chat_member.chat.id
+    if update.chat_member:
+        return update.chat_member.chat.id
+    return None
+
+
+def _callback_signature(update):
+    """Identify an inline button press so repeated presses can be coalesced."""
+    call = getattr(update, "callback_query", None)  # Queued calls have no callback_query
+    if call is None:
+        return None
+    return (call.from_user.id, call.data)
+
+
+class UpdateDispatcher:
+    """
+    Run telebot updates on a bounded worker pool.
+
+    Updates from the same chat are processed one at a time in arrival order,
+    while different chats are processed concurrently. The bot must be created
+    with threaded=False so that handlers run inside the worker that picked
+    up the update.
+
+    Telegram redelivers updates it considers unacknowledged, so update_ids
+    already seen are dropped using a bounded LRU. Once a chat has
+    max_chat_depth updates waiting, repeated button presses are coalesced
+    and anything else is shed.
+
+    submit_call() runs other work for a chat, such as posting a finished OCR
+    result, in the same order as the chat's updates.
+    """
+
+    def __init__(self, bot, max_workers: int = 8, max_chat_depth: int = 50, seen_capacity: int = 10000):
+        self.bot = bot
+        self.max_workers = max_workers
+        self.max_chat_depth = max_chat_depth
+        self.seen_capacity = seen_capacity
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="update-worker")
+        self._lock = threading.Lock()
+        self._pending = {}  # chat key -> deque of updates (or calls) waiting behind the one being processed
+        self._seen = OrderedDict()  # update_id -> None, oldest first
+        self._counters = {
+            "received": 0,
+            "processed": 0,
+            "failed": 0,
+            "duplicates_dropped": 0,
+            "coalesced": 0,
+            "shed": 0,
+        }
+
+    def submit(self, update):
+        """Queue an update for processing and return immediately."""
+        chat_id = get_update_chat_id(update)
+        # Updates without a chat have nothing to be ordered against
+        key = chat_id if chat_id is not None else ("update", update.update_id)
+
+        with self._lock:
+            self._counters["received"] += 1
+
+            if update.update_id in self._seen:
+                self._seen.move_to_end(update.update_id)
+                self._counters["duplicates_dropped"] += 1
+                logging.info(f"Dropped duplicate update {update.update_id} for chat {key}")
+                return
+            self._seen[update.update_id] = None
+            if len(self._seen) > self.seen_capacity:
+                self._seen.popitem(last=False)
+
+            pending = self._pending.get(key)
+            if pending is not None:
+                # A worker is already busy with this chat, it will pick this up next
+                if len(pending) >= self.max_chat_depth:
+                    self._apply_backpressure(key, pending, update)
+                    return
+                pending.append(update)
+                return
+            self._pending[key] = deque()
+
+        self._executor.submit(self._run, key, update)
+
+    def submit_call(self, chat_id, fn):
+        """Run fn() for a chat after the updates already queued for it, never alongside them."""
+        with self._lock:
+            pending = self._pending.get(chat_id)
+            if pending is not None:
+                # Calls carry results the chat is waiting for, so they are never shed
+                pending.append(fn)
+                return
+            self._pending[chat_id] = deque()
+
+        self._executor.submit(self._run, chat_id, fn)
+
+    def _apply_backpressure(self, key, pending, update):
+        """Decide what happens to an update arriving at a full chat queue. Called with the lock held."""
+        signature = _callback_signature(update)
+        if signature is not None and any(_callback_signature(queued) == signature for queued in pending):
+            # The same button press by the same user is already waiting
+            self._counters["coalesced"] += 1
+            logging.info(f"Coalesced update {update.update_id} for chat {key}")
+            return
+
+        self._counters["shed"] += 1
+        logging.warning(f"Chat {key} has {len(pending)} queued updates, shedding update {update.update_id}")
+
+    def metrics(self):
+        """Return queue depth and drop counters."""
+        with self._lock:
+            depths = [len(pending) for pending in self._pending.values()]
+            return {
+                **self._counters,
+                "active_chats": len(depths),
+                "queue_depth": sum(depths),
+                "max_chat_queue_depth": max(depths, default=0),
+                "max_chat_depth_limit": self.max_chat_depth,
+                "workers": self.max_workers,
+            }
+
+    def _run(self, key, update):
+        while True:
+            try:
+                if callable(update):
+                    update()
+                else:
+                    self.bot.process_new_updates([update])
+                failed = False
+            except Exception as e:
+                failed = True
+                logging.error(f"Failed to process {getattr(update, 'update_id', 'call')} for chat {key}: {e}")
+
+            with self._lock:
+                self._counters["failed" if failed else "processed"] += 1
+                pending = self._pending[key]
+                if not pending:
+                    del self._pending[key]
+                    return
+                update = pending.popleft()
+
+            try:
+                # Re-submit instead of looping so a busy chat cannot hog a worker
+                self._executor.submit(self._run, key, update)
+                return
+            except RuntimeError:
+                # The pool is shutting down, finish this chat's backlog here
+                continue
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting updates and optionally wait for queued ones to finish."""
+        self._executor.shutdown(wait=wait)
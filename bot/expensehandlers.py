@@ -42,7 +42,7 @@ def register_expense_handlers(bot):
                 bot.send_message(chat_id, "No group associated with this chat. Please use /create_group to create a new group.")
                 return
             
-            group_members_dict = Group.fetch_group_members_dict(group)
+            group_members_dict = group.fetch_roster().by_uuid
 
             if not user or not group_members_dict.get(user.uuid):
                 bot.reply_to(message, "You are not in the group! Please enter /join_group first.")
@@ -443,101 +443,6 @@ def register_expense_handlers(bot):
     #     except Exception as e:
     #         bot.send_message(chat_id, f"{e}")
 
-    # @bot.message_handler(commands=['settle_debt'])
-    # def settle_debt_start(message):
-    #     try:
-    #         # Check if this is a private chat
-    #         if not is_group_chat(message):
-    #             bot.reply_to(message, "This command can only be used in group chats.")
-    #             return
-                
-    #         chat_id = message.chat.id
-    #         user_id = message.from_user.id
-    #         user = User.fetch_from_db_by_user_id(user_id)
-
-    #         # Fetch the group by chat ID
-    #         group = Group.fetch_from_db_by_chat(chat_id)
-
-    #         if group is None:
-    #             bot.send_message(chat_id, "No group associated with this chat. Please use /create_group to create a new group.")
-    #             return
-            
-    #         # Fetch all debts for the group
-    #         debts = group.fetch_debts_by_group()
-
-    #         if not debts:
-    #             bot.send_message(chat_id, "There are no recorded debts in this group.")
-    #             return
-
-    #         # Ask for the usernames to settle debts with
-    #         msg = bot.send_message(chat_id, "Please reply this with the usernames you wish to settle debts with in the format:\n\n@username1 @username2 ...")
-            
-    #         # Set up a handler to wait for the user's reply
-    #         bot.register_next_step_handler(msg, process_settle_debt_reply, group, user, debts)
-        
-    #     except Exception as e:
-    #         bot.send_message(chat_id, f"{e}")
-
-    # def process_settle_debt_reply(message, group, user, debts):
-    #     try:
-    #         chat_id = message.chat.id
-    #         input_text = message.text  # Get the input text from the user's reply
-
-    #         if not input_text:
-    #             raise Exception("Please send a proper text!")
-
-    #         # Parse the message to extract the usernames
-    #         matches = re.findall(r'@(\w+)', input_text.strip())
-    #         if len(matches) < 1:
-    #             bot.send_message(chat_id, "Invalid format. Use @username1 @username2 ...")
-    #             return
-
-    #         usernames_dict = User.fetch_usernames_dict(matches)
-    #         # Fetch the users to whom the debts are being settled
-    #         creditors = []
-    #         for username in matches:
-    #             creditor = usernames_dict.get(username)
-    #             if creditor is None:
-    #                 bot.send_message(chat_id, f"User {username} not found.")
-    #                 return
-    #             creditors.append(creditor)
-
-    #         # Step 1: Aggregate debts (netted amounts owed between users)
-    #         user_balances = calculate_user_balances(debts)
-
-    #         # Step 2: Simplify debts (minimize transactions)
-    #         simplified_debts = simplify_debts(user_balances)
-
-    #         # Step 3: Settle the debts
-    #         settlements_to_add = []
-    #         for creditor in creditors:
-    #             settle_debt_transaction(simplified_debts, group, chat_id, user, creditor, settlements_to_add)
-            
-    #         if settlements_to_add:
-    #             Settlement.add_settlement_bulk(settlements_to_add)
-
-    #     except Exception as e:
-    #         bot.send_message(chat_id, f"{e}")
-
-    # def settle_debt_transaction(simplified_debts, group, chat_id, debtor, creditor, settlements_to_add):
-    #     """Settle the debt transaction between users."""
-    #     payer_id = debtor.uuid
-    #     payee_id = creditor.uuid
-        
-    #     for debtor_id, creditor_id, debt_amount in simplified_debts:
-    #         if debtor_id == payer_id and creditor_id == payee_id:
-    #             if debt_amount > 0:
-    #                 # Update the debt amount to 0
-    #                 group.update_debt(payer_id, creditor_id, debt_amount)
-    #                 group.update_debt(creditor_id, payer_id, -debt_amount)
-    #                 # Create a new settlement record
-    #                 settlement = Settlement(from_user=debtor, to_user=creditor, amount=debt_amount, group=group)
-    #                 settlements_to_add.append(settlement)
-    #                 bot.send_message(chat_id, f"Debt of ${debt_amount:.2f} from {debtor.username} to {creditor.username} settled.")
-    #                 return
-
-    #     bot.send_message(chat_id, f"No debt found from {debtor.username} to {creditor.username}!")
-
     # @bot.message_handler(commands=['show_settlements'])
     # def show_settlements(message):
     #     try:
@@ -0,0 +1,61 @@
+# bot/journal.py
+
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from client import supa
+from repository import repo
+
+# Set to a file path to keep the journal in a local SQLite database instead of Supabase
+REMINDER_JOURNAL_PATH = os.getenv("REMINDER_JOURNAL_PATH")
+
+
+def default_run_id():
+    """Reminders go out once a day at 12pm SGT, so a run is identified by its SGT date."""
+    return datetime.now(ZoneInfo("Asia/Singapore")).date().isoformat()
+
+
+class SupabaseReminderJournal:
+    """Records which chats a reminder run has delivered to in the reminder_deliveries table."""
+
+    def delivered_chat_ids(self, run_id: str):
+        rows = repo.run(repo.fetch_reminder_deliveries(run_id))
+        return {row['chat_id'] for row in rows}
+
+    def record_delivery(self, run_id: str, chat_id: int):
+        delivery_data = {
+            "run_id": run_id,
+            "chat_id": chat_id,
+            "delivered_at": datetime.now().isoformat(timespec="microseconds")
+        }
+        supa.table('reminder_deliveries').upsert(delivery_data, on_conflict='run_id,chat_id', ignore_duplicates=True).execute()
+
+
+class SqliteReminderJournal:
+    """Records which chats a reminder run has delivered to in a local SQLite file."""
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS reminder_deliveries ("
+                "run_id TEXT, chat_id INTEGER, delivered_at TEXT, PRIMARY KEY (run_id, chat_id))"
+            )
+
+    def delivered_chat_ids(self, run_id: str):
+        with self._lock:
+            rows = self._connection.execute("SELECT chat_id FROM reminder_deliveries WHERE run_id = ?", (run_id,)).fetchall()
+        return {chat_id for (chat_id,) in rows}
+
+    def record_delivery(self, run_id: str, chat_id: int):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO reminder_deliveries (run_id, chat_id, delivered_at) VALUES (?, ?, ?)",
+                (run_id, chat_id, datetime.now().isoformat(timespec="microseconds")),
+            )
+
+
+reminder_journal = SqliteReminderJournal(REMINDER_JOURNAL_PATH) if REMINDER_JOURNAL_PATH else SupabaseReminderJournal()
@@ -0,0 +1,104 @@
+# bot/ledger.py
+
+import os
+import sys
+import logging
+from client import supa
+from money import db_to_cents
+from repository import repo
+
+# The ledger keeps one net balance per group member instead of a debts row per member pair.
+# A trigger on the debts table keeps it current for every writer, bot and mini app alike.
+# Balances are only read from it once the trigger is installed and the ledger has been
+# backfilled with `python ledger.py migrate`.
+BALANCE_LEDGER_ENABLED = os.getenv("BALANCE_LEDGER_ENABLED", "false").lower() == "true"
+
+PAGE_SIZE = 1000
+
+
+def _balances_from_rows(rows):
+    balances = {row['user_id']: db_to_cents(row['balance']) for row in rows}
+    return {user_id: cents for user_id, cents in balances.items() if cents != 0}
+
+
+def fetch_balances(group_id: str):
+    """Fetch the ledger balances of a group as {user_uuid: cents}, omitting settled members."""
+    return _balances_from_rows(repo.run(repo.fetch_balances_by_group(group_id)))
+
+
+def delete_member_balance(group_id: str, user_id: str):
+    if BALANCE_LEDGER_ENABLED:
+        supa.table('balances').delete().eq('group_id', group_id).eq('user_id', user_id).execute()
+
+
+def _fetch_all_group_ids():
+    group_ids = []
+    start = 0
+    while True:
+        response = supa.table('groups').select('group_id').order('group_id').range(start, start + PAGE_SIZE - 1).execute()
+        group_ids.extend(row['group_id'] for row in response.data)
+        if len(response.data) < PAGE_SIZE:
+            return group_ids
+        start += PAGE_SIZE
+
+
+def _balances_from_debts(group_id: str):
+    from utils import calculate_user_balances  # utils imports classes, which imports this module
+
+    debts = repo.run(repo.fetch_debts_by_group(group_id))
+    balances = calculate_user_balances(debts) if debts else {}
+    return {user_id: cents for user_id, cents in balances.items() if cents != 0}
+
+
+def migrate(group_ids):
+    """
+    Rebuild the ledger rows of each group from its debts table rows.
+
+    Each group is rebuilt in one transaction by the rebuild_group_balances RPC, which
+    holds off debts writes meanwhile, so the live ledger trigger cannot interleave.
+    """
+    from classes import is_missing_rpc  # classes imports this module
+
+    for group_id in group_ids:
+        try:
+            response = supa.rpc("rebuild_group_balances", {"group_id_param": group_id}).execute()
+        except Exception as e:
+            if is_missing_rpc(e):
+                raise SystemExit("Install the rebuild_group_balances function (see README) before migrating.")
+            raise
+        print(f"Migrated {response.data} balances for group {group_id}")
+
+
+def check(group_ids):
+    """Compare the ledger with the debts table and return the ids of groups that disagree."""
+    mismatched = []
+    for group_id in group_ids:
+        # Read the ledger while the debts are being read
+        ledger_rows = repo.submit(repo.fetch_balances_by_group(group_id))
+        expected = _balances_from_debts(group_id)
+        actual = _balances_from_rows(ledger_rows.result())
+        if expected != actual:
+            mismatched.append(group_id)
+            for user_id in sorted(set(expected) | set(actual)):
+                if expected.get(user_id, 0) != actual.get(user_id, 0):
+                    print(f"Group {group_id} user {user_id}: debts say {expected.get(user_id, 0)}, ledger says {actual.get(user_id, 0)} (cents)")
+    print(f"Checked {len(group_ids)} groups, {len(mismatched)} inconsistent")
+    return mismatched
+
+
+if __name__ == '__main__':
+    # Usage: python ledger.py migrate|check [group_id ...]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("migrate", "check"):
+        print("Usage: python ledger.py migrate|check [group_id ...]")
+        sys.exit(2)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    command = sys.argv[1]
+    group_ids = sys.argv[2:] or _fetch_all_group_ids()
+    try:
+        if command == "migrate":
+            migrate(group_ids)
+        elif check(group_ids):
+            sys.exit(1)
+    finally:
+        repo.close()
@@ -11,10 +11,16 @@ from grouphandlers import register_group_handlers  # Import the handler registra
 from expensehandlers import register_expense_handlers # Import the handler registration function
 from receipthandlers import register_receipt_handlers  # Import the handler registration function
 from receipthandlersnlp import register_receipt_handlers_nlp  # Import the handler registration function
-from utils import process_reminders
-from pydantic import BaseModel
-from typing import List
-from utils import remove_underscore_markdown
+from utils import iter_reminders
+from typing import List, Union
+from notifications import Notification, SettleUpNotification, NotificationBuffer, NOTIFY_DEBOUNCE_SECONDS, group_messages_by_chat
+from dispatcher import UpdateDispatcher
+from sender import ReminderSender
+from journal import default_run_id, reminder_journal
+from starlette.concurrency import run_in_threadpool
+from repository import repo
+from cache import cache_stats
+from ocr import ocr_service
 
 load_dotenv()
 
@@ -24,8 +30,35 @@ WEBHOOK_PATH = f"/{API_TOKEN}/"
 
 WEBHOOK_URL = f"https://{WEBHOOK_HOST}{WEBHOOK_PATH}"
 
+# "pool" acknowledges Telegram immediately and runs handlers on a worker pool,
+# "inline" processes each update inside the webhook request
+WEBHOOK_DISPATCH = os.getenv("WEBHOOK_DISPATCH", "pool")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_MAX_CHAT_DEPTH = int(os.getenv("WEBHOOK_MAX_CHAT_DEPTH", 50))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", 10000))
+
 # Initialize the bot with the token from environment variables
-bot = telebot.TeleBot(API_TOKEN)
+# In pool mode the dispatcher owns concurrency, so handlers must run in the calling thread
+bot = telebot.TeleBot(API_TOKEN, threaded=WEBHOOK_DISPATCH != "pool")
+dispatcher = UpdateDispatcher(
+    bot,
+    max_workers=WEBHOOK_WORKERS,
+    max_chat_depth=WEBHOOK_MAX_CHAT_DEPTH,
+    seen_capacity=WEBHOOK_DEDUP_SIZE,
+) if WEBHOOK_DISPATCH == "pool" else None
+if dispatcher:
+    # OCR results are posted in order with the chat's other updates
+    ocr_service.run_in_chat = dispatcher.submit_call
+reminder_sender = ReminderSender(
+    bot,
+    global_per_second=float(os.getenv("TELEGRAM_GLOBAL_PER_SECOND", 25)),
+    chat_per_minute=float(os.getenv("TELEGRAM_CHAT_PER_MINUTE", 20)),
+    max_workers=int(os.getenv("REMINDER_SEND_WORKERS", 8)),
+)
+# Mini app notifications share the sender's flood limits and are merged per chat into digests
+notification_buffer = NotificationBuffer(
+    lambda chat_id, text: reminder_sender.send(chat_id, text, parse_mode='Markdown')
+) if NOTIFY_DEBOUNCE_SECONDS > 0 else None
 app = FastAPI()
 
 # Configure CORS middleware
@@ -77,9 +110,19 @@ register_expense_handlers(bot)
 async def telegram_webhook(req: Request):
     json_data = await req.json()
     update = telebot.types.Update.de_json(json_data)
-    bot.process_new_updates([update])
+    if dispatcher:
+        dispatcher.submit(update)
+    else:
+        bot.process_new_updates([update])
     return {"status": "ok"}
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "dispatcher": dispatcher.metrics() if dispatcher else None,
+        "caches": cache_stats(),
+    }
+
 # --- Set webhook on startup --- #
 
 @app.on_event("startup")
@@ -88,6 +131,37 @@ async def startup():
     bot.set_webhook(url=WEBHOOK_URL)
     bot.set_my_commands(commands)
 
+def send_reminders(run_id: str):
+    """
+    Compute and send every daily reminder not yet delivered in this run.
+
+    Each delivery is checkpointed in the reminder journal, so re-running the same
+    run_id after a crash or timeout only sends to the remaining chats. Returns
+    the sender's per-chat results and the number of chats skipped.
+
+    If the journal cannot be read (e.g. the reminder_deliveries table has not been
+    created yet), every reminder is sent and nothing is checkpointed.
+    """
+    try:
+        delivered = reminder_journal.delivered_chat_ids(run_id)
+        on_sent = lambda chat_id: reminder_journal.record_delivery(run_id, chat_id)
+    except Exception as e:
+        print(f"Reminder journal unavailable, sending without checkpoints: {e}")
+        delivered, on_sent = set(), None
+    skipped = 0
+
+    def pending_messages():
+        nonlocal skipped
+        # Debt messages stream in batch by batch, so sending starts before every group is computed
+        for chat_id, debt_string in iter_reminders():
+            if chat_id in delivered:
+                skipped += 1
+                continue
+            yield chat_id, f"🌴 Daily Debt Reminder 🌴\n\n{debt_string}\n\n"
+
+    results = reminder_sender.send_all(pending_messages(), on_sent=on_sent)
+    return results, skipped
+
 @app.post("/send-daily-reminder")
 async def send_daily_reminder(req: Request):
     try:
@@ -99,27 +173,23 @@ async def send_daily_reminder(req: Request):
         if not api_key or api_key != expected_key:
             return Response(status_code=status.HTTP_401_UNAUTHORIZED)
 
-        # Get debt messages for each group using process_reminders
-        chat_id_to_debt_string = process_reminders()
-        
-        # Send reminders
-        sent_count = 0
-        for chat_id, debt_string in chat_id_to_debt_string.items():
-            try:
-                reminder_message = (
-                    f"🌴 Daily Debt Reminder 🌴\n\n"
-                    f"{debt_string}\n\n"
-                )
-                bot.send_message(chat_id, reminder_message)
-                sent_count += 1
-            except Exception as e:
-                print(f"Failed to send reminder to chat {chat_id}: {e}")
-                continue
+        # Retries of the same day's run resume from the journal; pass run_id to force a fresh run
+        run_id = req.query_params.get('run_id') or default_run_id()
+
+        # Sending blocks on Telegram, so run it off the event loop
+        results, skipped = await run_in_threadpool(send_reminders, run_id)
+
+        failures = {result["chat_id"]: result["error"] for result in results if result["status"] != "sent"}
+        for chat_id, error in failures.items():
+            print(f"Failed to send reminder to chat {chat_id}: {error}")
 
         return {
             "status": "success",
-            "reminders_sent": sent_count,
-            "total_groups": len(chat_id_to_debt_string)
+            "run_id": run_id,
+            "reminders_sent": len(results) - len(failures),
+            "already_delivered": skipped,
+            "total_groups": len(results) + skipped,
+            "failures": failures
         }
     except Exception as e:
         return Response(
@@ -130,30 +200,14 @@ async def send_daily_reminder(req: Request):
 # --- Optional: remove webhook on shutdown --- #
 @app.on_event("shutdown")
 async def shutdown():
+    if notification_buffer:
+        # Flushing sends every buffered digest, which blocks on Telegram
+        await run_in_threadpool(notification_buffer.close)
     bot.remove_webhook()
-
-# Define models for request data
-class Split(BaseModel):
-    username: str
-    amount: str
-
-class Settlement(BaseModel):
-    from_user: str
-    to_user: str
-    amount: str
-
-class ExpenseNotification(BaseModel):
-    chat_id: int
-    action: str
-    description: str
-    amount: str
-    payer: str
-    splits: List[Split]
-
-class SettlementNotification(BaseModel):
-    chat_id: int
-    action: str
-    settlements: List[Settlement]
+    if dispatcher:
+        dispatcher.shutdown()
+    ocr_service.shutdown()
+    repo.close()
 
 # Authentication middleware
 async def verify_api_key(request: Request):
@@ -177,111 +231,54 @@ async def options_notify():
         }
     )
 
+def send_notifications(notifications):
+    """Send rendered notifications, one message per chat, returning {chat_id: error} for failed sends."""
+    failures = {}
+    for chat_id, text in group_messages_by_chat(notifications):
+        try:
+            bot.send_message(chat_id, text, parse_mode='Markdown')
+        except Exception as send_err:
+            failures[chat_id] = str(send_err)
+    return failures
+
 @app.post("/api/notify")
 async def handle_notification(
-    request: Request,
+    payload: Union[Notification, List[Notification]] = Body(...),
     authenticated: bool = Depends(verify_api_key)
 ):
+    """
+    Announce changes made in the mini app. Accepts one notification or a list of them;
+    notifications for the same chat in a batch are sent as a single message.
+
+    With NOTIFY_DEBOUNCE_SECONDS set, notifications are queued and sent as per-chat digests.
+    """
+    notifications = payload if isinstance(payload, list) else [payload]
+    if notification_buffer:
+        for notification in notifications:
+            notification_buffer.add(notification)
+        if isinstance(payload, SettleUpNotification) and not payload.settlements:
+            return {"status": "warning", "message": "No settlements were made"}
+        return {"status": "queued", "notifications": len(notifications)}
+
     try:
-        # Parse the request body
-        data = await request.json()
-        
-        chat_id = data.get('chat_id')
-        action = data.get('action')
-        
-        if not chat_id:
-            raise HTTPException(status_code=400, detail="Missing chat_id field")
-        
-        if action == 'add_expense':
-            # Handle expense notification
-            description = data.get('description')
-            amount = data.get('amount')
-            payer = data.get('payer')
-            splits = data.get('splits', [])
-            
-            # Format the splits for display
-            splits_text = ""
-            for split in splits:
-                username = split.get('username')
-                split_amount = split.get('amount')
-                splits_text += f"\n- @{username}: ${split_amount}"
-            
-            # Send a message to the group with the expense details
-            notification_text = (
-                f"💰 *New Expense Added*\n"
-                f"*Description:* {description}\n"
-                f"*Amount:* ${amount}\n"
-                f"*Paid by:* @{payer}\n"
-                f"*Split with:*{splits_text}"
-            )
-            
-            try:
-                bot.send_message(chat_id, remove_underscore_markdown(notification_text), parse_mode='Markdown')
-            except Exception as send_err:
-                return {"status": "error", "message": f"Failed to send message: {str(send_err)}"}
-            
-        elif action == 'settle_up':
-            # Handle settlement notification
-            settlements = data.get('settlements', [])
-            
-            if not settlements:
-                return {"status": "warning", "message": "No settlements were made"}
-            
-            # Format the settlement details for display
-            settlements_text = ""
-            for settlement in settlements:
-                from_user = settlement.get('from')
-                to_user = settlement.get('to')
-                amount = settlement.get('amount')
-                settlements_text += f"\n- @{from_user} → @{to_user}: ${amount}"
-            
-            # Send a message to the group with the settlement details
-            notification_text = (
-                f"✅ *Settlements Completed*\n"
-                f"The following debts have been settled:{settlements_text}"
-            )
-            
-            bot.send_message(chat_id, remove_underscore_markdown(notification_text), parse_mode='Markdown')
-            
-        elif action == 'delete_expense':
-            # Handle expense deletion notification
-            description = data.get('description')
-            amount = data.get('amount')
-            payer = data.get('payer')
-            
-            # Send a message to the group about the deleted expense
-            notification_text = (
-                f"🗑️ *Expense Deleted*\n"
-                f"*Description:* {description}\n"
-                f"*Amount:* ${amount}\n"
-                f"*Paid by:* @{payer}"
-            )
-            
-            bot.send_message(chat_id, remove_underscore_markdown(notification_text), parse_mode='Markdown')
-
-        elif action == "delete_settlement":
-            # Handle settlement deletion notification
-            from_user = data.get('from_user')
-            to_user = data.get('to_user')
-            amount = data.get('amount')
-            
-            # Send a message to the group about the deleted settlement
-            notification_text = (
-                f"🗑️ *Settlement Deleted*\n"
-                f"*From:* @{from_user}\n"
-                f"*To:* @{to_user}\n"
-                f"*Amount:* ${amount}"
-            )
-            
-            bot.send_message(chat_id, remove_underscore_markdown(notification_text), parse_mode='Markdown')
-            
-        else:
-            raise HTTPException(status_code=400, detail="Unknown action type")
-        
-        return {"status": "success"}
-        
+        # Sending blocks on Telegram, so run it off the event loop
+        failures = await run_in_threadpool(send_notifications, notifications)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing notification: {str(e)}")
 
+    if not isinstance(payload, list):
+        if isinstance(payload, SettleUpNotification) and not payload.settlements:
+            return {"status": "warning", "message": "No settlements were made"}
+        if failures:
+            return {"status": "error", "message": f"Failed to send message: {failures[payload.chat_id]}"}
+        return {"status": "success"}
+
+    return {
+        "status": "error" if failures else "success",
+        "notifications": len(notifications),
+        "failures": failures
+    }
+
 if __name__ == '__main__':
+    # For local runs only: OCR workers re-run this file's top level, so deploys start uvicorn directly
     uvicorn.run("main:app", host="0.0.0.0", port=int(os.environ.get("PORT", 8443)))
\ No newline at end of file
@@ -0,0 +1,136 @@
+# bot/maintenance.py
+
+import os
+import sys
+import logging
+from classes import is_missing_rpc
+from client import supa
+from ledger import BALANCE_LEDGER_ENABLED
+from repository import repo
+
+# Offline garbage collection of rows left behind by groups deleted before delete_group_cascade existed.
+# Usage (from the bot directory): python maintenance.py gc [--dry-run]
+
+PAGE_SIZE = 1000
+# Ids per delete, small enough to keep the in.(...) filter URL short
+GC_BATCH_SIZE = int(os.getenv("GC_BATCH_SIZE", 100))
+
+# Tables whose rows belong to a group, in the order orphans are deleted
+GROUP_TABLES = ['debts', 'settlements', 'balances', 'expenses', 'group_members']
+
+
+def _fetch_column(table: str, column: str, **filters):
+    """Return the distinct values of one column, reading a page of rows per distinct-value window."""
+    values = set()
+    last = None
+    while True:
+        query = supa.table(table).select(column)
+        for key, ids in filters.items():
+            query = query.in_(key, ids)
+        if last is not None:
+            # Resume after the largest value seen, skipping the rest of its rows
+            query = query.gt(column, last)
+        response = query.order(column).limit(PAGE_SIZE).execute()
+        values.update(row[column] for row in response.data)
+        if len(response.data) < PAGE_SIZE:
+            return values
+        last = response.data[-1][column]
+
+
+def _batches(ids):
+    ids = sorted(ids)
+    for i in range(0, len(ids), GC_BATCH_SIZE):
+        yield ids[i:i + GC_BATCH_SIZE]
+
+
+def find_orphan_group_ids(table: str, live_group_ids: set):
+    """Return the group ids referenced by table that no longer exist in groups."""
+    return _fetch_column(table, 'group_id') - live_group_ids
+
+
+def _still_missing(table: str, column: str, batch):
+    # Groups (and expenses) are written before their rows, so one created since the scan shows up here
+    return sorted(set(batch) - _fetch_column(table, column, **{column: batch}))
+
+
+def find_orphan_split_expense_ids():
+    """Return the expense ids referenced by expense_splits that no longer exist in expenses."""
+    split_expense_ids = _fetch_column('expense_splits', 'expense_id')
+    orphans = set()
+    for batch in _batches(split_expense_ids):
+        live = _fetch_column('expenses', 'expense_id', expense_id=batch)
+        orphans.update(set(batch) - live)
+    return orphans
+
+
+def delete_in_batches(table: str, column: str, ids, parent_table: str):
+    """
+    Delete the rows of table whose column is in ids, GC_BATCH_SIZE ids per request. Returns the rows deleted.
+
+    Each batch is checked against parent_table right before it is deleted, so ids that
+    have appeared there since the scan (a group created meanwhile) are left alone.
+    """
+    deleted = 0
+    for batch in _batches(ids):
+        batch = _still_missing(parent_table, column, batch)
+        if batch:
+            response = supa.table(table).delete().in_(column, batch).execute()
+            deleted += len(response.data)
+    return deleted
+
+
+def gc_rpc(dry_run: bool = False):
+    """Run the whole collection in the database with gc_orphaned_rows. Returns False if it is not installed."""
+    try:
+        response = supa.rpc("gc_orphaned_rows", {"dry_run": dry_run}).execute()
+    except Exception as e:
+        if not is_missing_rpc(e):
+            raise
+        logging.warning("gc_orphaned_rows RPC is not installed, scanning tables from the client")
+        return False
+    for row in response.data:
+        verb = "would delete" if dry_run else "deleted"
+        print(f"{row['table_name']}: {verb} {row['orphan_rows']} rows")
+    return True
+
+
+def gc(dry_run: bool = False):
+    """Find and delete rows whose group or expense no longer exists."""
+    if gc_rpc(dry_run):
+        return
+
+    live_group_ids = _fetch_column('groups', 'group_id')
+    tables = GROUP_TABLES if BALANCE_LEDGER_ENABLED else [table for table in GROUP_TABLES if table != 'balances']
+
+    for table in tables:
+        orphan_group_ids = find_orphan_group_ids(table, live_group_ids)
+        if not orphan_group_ids:
+            print(f"{table}: no orphans")
+            continue
+        if dry_run:
+            print(f"{table}: rows for {len(orphan_group_ids)} deleted groups")
+            continue
+        deleted = delete_in_batches(table, 'group_id', orphan_group_ids, 'groups')
+        print(f"{table}: deleted {deleted} rows for {len(orphan_group_ids)} deleted groups")
+
+    # Runs after the expenses pass, so it also catches splits of the expenses just deleted
+    orphan_expense_ids = find_orphan_split_expense_ids()
+    if not orphan_expense_ids:
+        print("expense_splits: no orphans")
+    elif dry_run:
+        print(f"expense_splits: rows for {len(orphan_expense_ids)} deleted expenses")
+    else:
+        deleted = delete_in_batches('expense_splits', 'expense_id', orphan_expense_ids, 'expenses')
+        print(f"expense_splits: deleted {deleted} rows for {len(orphan_expense_ids)} deleted expenses")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != "gc":
+        print("Usage: python maintenance.py gc [--dry-run]")
+        sys.exit(2)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    try:
+        gc(dry_run="--dry-run" in sys.argv[2:])
+    finally:
+        repo.close()
@@ -0,0 +1,54 @@
+# bot/money.py
+
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Amounts are carried as integer cents so sums and splits are exact
+CENTS_PER_DOLLAR = 100
+MAX_AMOUNT_CENTS = 10**8 * CENTS_PER_DOLLAR
+
+
+def to_cents(value) -> int:
+    """Convert a dollar amount (str, int, float or Decimal) to integer cents, rounding half up."""
+    try:
+        dollars = Decimal(str(value).strip())
+        if not dollars.is_finite():
+            raise ValueError(f"{value!r} is not a valid amount")
+        # quantize raises InvalidOperation for values beyond the context's 28 digits, e.g. "1e30"
+        return int((dollars * CENTS_PER_DOLLAR).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError(f"{value!r} is not a valid amount")
+
+
+def db_to_cents(amount) -> int:
+    """
+    Convert a DECIMAL(10, 2) amount read from the database to integer cents.
+
+    Such values have at most 10 significant digits, so rounding the float times 100
+    recovers the exact cents without the cost of a Decimal round trip.
+    """
+    return round(amount * CENTS_PER_DOLLAR)
+
+
+def from_cents(cents: int) -> float:
+    """Convert integer cents to dollars for database rows and RPC payloads."""
+    return cents / CENTS_PER_DOLLAR
+
+
+def format_cents(cents: int) -> str:
+    """Format integer cents as a dollar string with two decimals, e.g. 1234 -> '12.34'."""
+    sign = "-" if cents < 0 else ""
+    dollars, remainder = divmod(abs(cents), CENTS_PER_DOLLAR)
+    return f"{sign}{dollars}.{remainder:02d}"
+
+
+def split_evenly(total_cents: int, parts: int) -> list:
+    """
+    Split total_cents into parts shares that sum exactly to total_cents.
+
+    Shares differ by at most one cent. The leftover cents go to the first
+    total_cents % parts shares, so the same input always splits the same way.
+    """
+    if parts <= 0:
+        return []
+    share, remainder = divmod(total_cents, parts)
+    return [share + 1 if i < remainder else share for i in range(parts)]
@@ -0,0 +1,145 @@
+# bot/nlpclient.py
+
+import os
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Load environment variables for security
+API_URL = os.getenv("NLP_API_URL", "https://c8wgwo8w0c8swww08oo088kg.deploy.jensenhshoots.com/parse-receipt/")
+API_KEY = os.getenv("NLP_API_KEY", "your-default-secure-api-key")  # Replace with your actual API key
+
+NLP_CONNECT_TIMEOUT = float(os.getenv("NLP_CONNECT_TIMEOUT", 5))
+# Parsing a receipt with the model is slow, so reads get much longer than connects
+NLP_READ_TIMEOUT = float(os.getenv("NLP_READ_TIMEOUT", 60))
+NLP_MAX_CONCURRENCY = int(os.getenv("NLP_MAX_CONCURRENCY", 4))
+NLP_MAX_RETRIES = int(os.getenv("NLP_MAX_RETRIES", 2))
+NLP_BACKOFF_FACTOR = float(os.getenv("NLP_BACKOFF_FACTOR", 0.5))
+# Consecutive failures that open the circuit, and seconds it stays open before a trial request
+NLP_FAILURE_THRESHOLD = int(os.getenv("NLP_FAILURE_THRESHOLD", 3))
+NLP_RESET_TIMEOUT = float(os.getenv("NLP_RESET_TIMEOUT", 60))
+
+
+class NLPUnavailable(Exception):
+    """The NLP API is degraded, busy or unreachable; callers should fall back to local OCR."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while.
+
+    After failure_threshold consecutive failures the circuit opens and allow()
+    returns False for reset_timeout seconds. Then a single trial call is let
+    through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = NLP_FAILURE_THRESHOLD, reset_timeout: float = NLP_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.warning(f"NLP API failed {self._failures} times in a row, pausing calls for {self.reset_timeout:.0f}s")
+                self._opened_at = time.monotonic()
+
+
+class NLPReceiptClient:
+    """
+    Client for the NLP receipt API over a pooled keep-alive session.
+
+    Requests time out, are retried with backoff on connection errors and 5xx
+    responses, and at most max_concurrency run at once. Failures feed a circuit
+    breaker; while it is open, and when no slot frees up in time, parse()
+    raises NLPUnavailable straight away.
+    """
+
+    def __init__(self, url: str = API_URL, api_key: str = API_KEY, connect_timeout: float = NLP_CONNECT_TIMEOUT,
+                 read_timeout: float = NLP_READ_TIMEOUT, max_concurrency: int = NLP_MAX_CONCURRENCY,
+                 max_retries: int = NLP_MAX_RETRIES, backoff_factor: float = NLP_BACKOFF_FACTOR,
+                 breaker: CircuitBreaker = None):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._session = requests.Session()
+        self._session.headers.update({"x-api-key": api_key})
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["POST"]),  # Parsing has no side effects, so POSTs are safe to retry
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=retry)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def parse(self, image_bytes: bytes):
+        """Send a receipt image to the API and return the response JSON."""
+        # Waiting longer than a connect timeout for a slot means the API is saturated.
+        # While the circuit is open no requests are in flight, so this returns at once.
+        if not self._slots.acquire(timeout=self.timeout[0]):
+            raise NLPUnavailable("The receipt API is busy.")
+        if not self.breaker.allow():
+            self._slots.release()
+            raise NLPUnavailable("The receipt API is temporarily unavailable.")
+        try:
+            files = {
+                "file": ("receipt.jpg", image_bytes, "image/jpeg")
+            }
+            response = self._session.post(self.url, files=files, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise NLPUnavailable(f"The receipt API could not be reached: {e}")
+        finally:
+            self._slots.release()
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise NLPUnavailable(f"API returned status code {response.status_code}: {response.text}")
+        # The API answered; a 4xx is about this receipt, not the API's health
+        self.breaker.record_success()
+        if response.status_code != 200:
+            raise Exception(f"API returned status code {response.status_code}: {response.text}")
+        return response.json()
+
+    def close(self):
+        self._session.close()
+
+
+nlp_client = NLPReceiptClient()
@@ -0,0 +1,266 @@
+# bot/notifications.py
+
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, List, Literal, Union
+from pydantic import BaseModel, ConfigDict, Field
+from utils import remove_underscore_markdown
+
+# Seconds to hold mini app notifications for a chat so a burst of edits goes out as one digest; 0 sends immediately
+NOTIFY_DEBOUNCE_SECONDS = float(os.getenv("NOTIFY_DEBOUNCE_SECONDS", 3))
+# A chat's buffer is flushed early once it holds this many notifications
+NOTIFY_MAX_BATCH = int(os.getenv("NOTIFY_MAX_BATCH", 10))
+# Threads sending digests; sends can wait seconds on a chat's rate limit, and each chat uses one thread at a time
+NOTIFY_FLUSH_WORKERS = int(os.getenv("NOTIFY_FLUSH_WORKERS", 4))
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+# Message templates, built once at import. Amounts arrive from the mini app already formatted to 2 dp.
+ADD_EXPENSE_TEMPLATE = (
+    "💰 *New Expense Added*\n"
+    "*Description:* {description}\n"
+    "*Amount:* ${amount}\n"
+    "*Paid by:* @{payer}\n"
+    "*Split with:*{splits}"
+)
+SPLIT_LINE_TEMPLATE = "\n- @{username}: ${amount}"
+SETTLE_UP_TEMPLATE = (
+    "✅ *Settlements Completed*\n"
+    "The following debts have been settled:{settlements}"
+)
+SETTLEMENT_LINE_TEMPLATE = "\n- @{from_user} → @{to_user}: ${amount}"
+DELETE_EXPENSE_TEMPLATE = (
+    "🗑️ *Expense Deleted*\n"
+    "*Description:* {description}\n"
+    "*Amount:* ${amount}\n"
+    "*Paid by:* @{payer}"
+)
+DELETE_SETTLEMENT_TEMPLATE = (
+    "🗑️ *Settlement Deleted*\n"
+    "*From:* @{from_user}\n"
+    "*To:* @{to_user}\n"
+    "*Amount:* ${amount}"
+)
+DIGEST_TEMPLATE = "📝 *{count} updates from CoconutSplit*\n\n{messages}"
+DIGEST_SEPARATOR = "\n\n"
+
+
+class Split(BaseModel):
+    username: str
+    amount: str
+
+
+class SettledDebt(BaseModel):
+    # The mini app sends "from" and "to", which are not valid Python names
+    model_config = ConfigDict(populate_by_name=True)
+
+    from_user: str = Field(alias="from")
+    to_user: str = Field(alias="to")
+    amount: str
+
+
+class AddExpenseNotification(BaseModel):
+    chat_id: int
+    action: Literal["add_expense"]
+    description: str
+    amount: str
+    payer: str
+    splits: List[Split] = []
+
+    def render(self):
+        splits = "".join(SPLIT_LINE_TEMPLATE.format(username=split.username, amount=split.amount) for split in self.splits)
+        return ADD_EXPENSE_TEMPLATE.format(description=self.description, amount=self.amount, payer=self.payer, splits=splits)
+
+
+class SettleUpNotification(BaseModel):
+    chat_id: int
+    action: Literal["settle_up"]
+    settlements: List[SettledDebt] = []
+
+    def render(self):
+        if not self.settlements:
+            return None
+        settlements = "".join(
+            SETTLEMENT_LINE_TEMPLATE.format(from_user=debt.from_user, to_user=debt.to_user, amount=debt.amount)
+            for debt in self.settlements
+        )
+        return SETTLE_UP_TEMPLATE.format(settlements=settlements)
+
+
+class DeleteExpenseNotification(BaseModel):
+    chat_id: int
+    action: Literal["delete_expense"]
+    description: str
+    amount: str
+    payer: str
+
+    def render(self):
+        return DELETE_EXPENSE_TEMPLATE.format(description=self.description, amount=self.amount, payer=self.payer)
+
+
+class DeleteSettlementNotification(BaseModel):
+    chat_id: int
+    action: Literal["delete_settlement"]
+    from_user: str
+    to_user: str
+    amount: str
+
+    def render(self):
+        return DELETE_SETTLEMENT_TEMPLATE.format(from_user=self.from_user, to_user=self.to_user, amount=self.amount)
+
+
+# Validation picks the model from "action" directly instead of trying each model in turn
+Notification = Annotated[
+    Union[AddExpenseNotification, SettleUpNotification, DeleteExpenseNotification, DeleteSettlementNotification],
+    Field(discriminator="action"),
+]
+
+
+def render_notification(notification):
+    """Return the Markdown message for a notification, or None if there is nothing to announce."""
+    text = notification.render()
+    return remove_underscore_markdown(text) if text else None
+
+
+def render_digest(texts):
+    """Merge rendered notifications for one chat into a single message."""
+    if len(texts) == 1:
+        return texts[0]
+    return DIGEST_TEMPLATE.format(count=len(texts), messages=DIGEST_SEPARATOR.join(texts))
+
+
+def group_messages_by_chat(notifications):
+    """
+    Render notifications and join those for the same chat into one message each.
+
+    Returns a list of (chat_id, text) in the order each chat first appears.
+    """
+    texts_by_chat = {}
+    for notification in notifications:
+        text = render_notification(notification)
+        if text:
+            texts_by_chat.setdefault(notification.chat_id, []).append(text)
+    return [(chat_id, render_digest(texts)) for chat_id, texts in texts_by_chat.items()]
+
+
+class NotificationBuffer:
+    """
+    Per-chat debounce buffer that merges notifications into digest messages.
+
+    The first notification for a chat starts a window of window seconds. Everything
+    that arrives for the chat before it closes is sent as one digest. A chat is
+    flushed early once it holds max_batch notifications or its digest would pass
+    Telegram's length limit. close() flushes everything still buffered.
+
+    add() never sends itself, so it is safe to call from the event loop: digests
+    are handed to a small thread pool. A chat has at most one digest being sent at
+    a time, with the rest queued behind it, so digests arrive in the order they
+    were flushed.
+    """
+
+    def __init__(self, send, window: float = NOTIFY_DEBOUNCE_SECONDS, max_batch: int = NOTIFY_MAX_BATCH,
+                 flush_workers: int = NOTIFY_FLUSH_WORKERS):
+        self._send = send  # send(chat_id, text), may return a ReminderSender result dict
+        self._executor = ThreadPoolExecutor(max_workers=flush_workers, thread_name_prefix="notify-flush")
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # chat_id -> rendered texts, oldest first
+        self._timers = {}  # chat_id -> threading.Timer closing the chat's window
+        self._outbox = {}  # chat_id -> digests waiting behind the one being sent; present while one is in flight
+        self._lock = threading.Lock()
+        self._sent = threading.Condition(self._lock)  # Notified when a chat's outbox empties
+        self._closed = False
+
+    def add(self, notification):
+        """Buffer a notification, or queue it for sending straight away if the buffer is closed."""
+        text = render_notification(notification)
+        if not text:
+            return
+        chat_id = notification.chat_id
+        batches = []  # digests to send once the lock is released
+        with self._lock:
+            if self._closed:
+                batches.append([text])
+            else:
+                texts = self._pending.get(chat_id, [])
+                if texts and len(render_digest(texts + [text])) > MAX_MESSAGE_LENGTH:
+                    # Send what is buffered so far and start a new digest with this notification
+                    batches.append(self._take(chat_id))
+                texts = self._pending.setdefault(chat_id, [])
+                texts.append(text)
+                if len(texts) >= self.max_batch:
+                    batches.append(self._take(chat_id))
+                elif chat_id not in self._timers:
+                    timer = threading.Timer(self.window, self.flush, args=(chat_id,))
+                    timer.daemon = True
+                    self._timers[chat_id] = timer
+                    timer.start()
+        for texts in batches:
+            self._enqueue(chat_id, texts)
+
+    def _take(self, chat_id):
+        # Caller holds the lock
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        return self._pending.pop(chat_id, [])
+
+    def _enqueue(self, chat_id, texts):
+        with self._lock:
+            outbox = self._outbox.get(chat_id)
+            if outbox is not None:
+                outbox.append(texts)
+                return
+            self._outbox[chat_id] = deque()
+        self._executor.submit(self._drain, chat_id, texts)
+
+    def _drain(self, chat_id, texts):
+        # Sends the chat's digests one after another until its outbox is empty
+        while True:
+            self._deliver(chat_id, texts)
+            with self._lock:
+                outbox = self._outbox[chat_id]
+                if not outbox:
+                    del self._outbox[chat_id]
+                    self._sent.notify_all()
+                    return
+                texts = outbox.popleft()
+
+    def _deliver(self, chat_id, texts):
+        try:
+            result = self._send(chat_id, render_digest(texts))
+        except Exception as e:
+            logging.error(f"Failed to send {len(texts)} notifications to chat {chat_id}: {e}")
+            return
+        # ReminderSender reports failures in its result instead of raising
+        if isinstance(result, dict) and result.get("status") == "failed":
+            logging.error(f"Failed to send {len(texts)} notifications to chat {chat_id}: {result.get('error')}")
+
+    def flush(self, chat_id):
+        """Queue everything buffered for a chat to be sent now."""
+        with self._lock:
+            texts = self._take(chat_id)
+        if texts:
+            self._enqueue(chat_id, texts)
+
+    def flush_all(self):
+        with self._lock:
+            chat_ids = list(self._pending)
+        for chat_id in chat_ids:
+            self.flush(chat_id)
+
+    def close(self):
+        """Flush every chat, wait until it has all been sent, and send later notifications immediately."""
+        with self._lock:
+            self._closed = True
+        self.flush_all()
+        with self._lock:
+            while self._outbox:
+                self._sent.wait()
+
+    def pending_count(self):
+        with self._lock:
+            return sum(len(texts) for texts in self._pending.values())
@@ -0,0 +1,207 @@
+# bot/ocr.py
+
+import os
+import io
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+import pytesseract
+from PIL import Image
+from receiptparser import parse_receipt_text
+from receiptimage import OCR_PREPROCESS, OCR_TARGET_DPI, preprocess_receipt
+
+# Worker processes import this module on their own, so it must not import classes or client.
+# Spawned workers also re-run the parent's __main__ script, so the bot is started through uvicorn
+# (Procfile, Dockerfile) rather than `python main.py`, whose top level builds the bot and app.
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", 2))
+# Receipts allowed to wait for a worker before new uploads are turned away
+OCR_MAX_QUEUE = int(os.getenv("OCR_MAX_QUEUE", 8))
+OCR_TIMEOUT_SECONDS = float(os.getenv("OCR_TIMEOUT_SECONDS", 60))
+# Threads running completion callbacks when no per-chat runner is set
+OCR_CALLBACK_WORKERS = int(os.getenv("OCR_CALLBACK_WORKERS", 2))
+TESSERACT_CMD = os.getenv("TESSERACT_CMD", '/app/.apt/usr/bin/tesseract')
+
+pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+
+
+def run_ocr(image_bytes: bytes, timeout: float = OCR_TIMEOUT_SECONDS):
+    """
+    Processes the receipt image using Tesseract OCR and parses the text to extract items and amounts.
+
+    Runs in an OCR worker process on the downloaded image bytes. Unless OCR_PREPROCESS
+    is off, the photo is first cleaned up and shrunk by preprocess_receipt. Tesseract
+    is killed if it runs longer than timeout seconds.
+
+    Returns:
+        list: A list of dictionaries containing 'item' and 'amount'.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        if OCR_PREPROCESS:
+            image = preprocess_receipt(image)
+            # The preprocessed image is scaled to a known DPI, so Tesseract need not guess it
+            text = pytesseract.image_to_string(image, config=f"--dpi {OCR_TARGET_DPI}", timeout=timeout)
+        else:
+            text = pytesseract.image_to_string(image, timeout=timeout)
+    except Exception as e:
+        raise Exception(f"OCR processing failed: {str(e)}")
+    return parse_receipt_text(text)
+
+
+class OCRQueueFull(Exception):
+    pass
+
+
+class _OCRJob:
+    def __init__(self, key, future, on_done):
+        self.key = key
+        self.future = future
+        self.on_done = on_done
+        self.timer = None
+        self.settled = False
+        self.cancelled = False  # Set by cancel() while the result waits to be delivered
+
+
+class OCRService:
+    """
+    Runs receipt OCR on a process pool so a slow receipt never blocks a handler thread.
+
+    At most max_workers receipts are read at once and max_queue more may wait;
+    beyond that submit() raises OCRQueueFull. Jobs are keyed (by chat), so a new
+    upload or cancel() drops the chat's previous job. on_done(items, error) is
+    called once per job that was not cancelled, with error set if OCR failed or
+    the job did not finish within timeout seconds.
+
+    on_done never runs on the pool's own threads. If run_in_chat(key, fn) is set
+    (main sets it to the update dispatcher), on_done runs in order with the
+    chat's updates; otherwise it runs on a small callback thread pool.
+    """
+
+    def __init__(self, max_workers: int = OCR_WORKERS, max_queue: int = OCR_MAX_QUEUE, timeout: float = OCR_TIMEOUT_SECONDS,
+                 callback_workers: int = OCR_CALLBACK_WORKERS):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.run_in_chat = None
+        self._callbacks = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="ocr-callback")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._jobs = {}  # key -> _OCRJob
+        self._delivering = {}  # key -> settled _OCRJob whose on_done has not run yet
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # Caller holds the lock. Spawned workers do not inherit the bot's threads or connections.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def submit(self, key, image_bytes: bytes, on_done):
+        """Queue a receipt for OCR, replacing any job already running for key."""
+        if not self._slots.acquire(blocking=False):
+            raise OCRQueueFull("Too many receipts are being processed right now. Please try again in a minute.")
+        self.cancel(key)
+        try:
+            with self._lock:
+                try:
+                    future = self._pool().submit(run_ocr, image_bytes, self.timeout)
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed for memory); start a fresh pool
+                    self._executor = None
+                    future = self._pool().submit(run_ocr, image_bytes, self.timeout)
+                job = self._jobs[key] = _OCRJob(key, future, on_done)
+        except Exception:
+            self._slots.release()
+            raise
+
+        # Tesseract enforces the timeout itself; this also covers time spent queued or stuck elsewhere
+        job.timer = threading.Timer(self.timeout * 2, self._expire, args=(job,))
+        job.timer.daemon = True
+        job.timer.start()
+        future.add_done_callback(lambda _: self._finish(job))
+        return future
+
+    def _settle(self, job):
+        # Marks the job as handled exactly once, returning False if it already was
+        with self._lock:
+            if job.settled:
+                return False
+            job.settled = True
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+                self._delivering[job.key] = job
+        if job.timer is not None:
+            job.timer.cancel()
+        return True
+
+    def _finish(self, job):
+        self._slots.release()
+        if not self._settle(job):
+            return
+        try:
+            items, error = job.future.result(), None
+        except CancelledError:
+            return
+        except Exception as e:
+            items, error = None, e
+        self._notify(job, items, error)
+
+    def _expire(self, job):
+        if not self._settle(job):
+            return
+        job.future.cancel()
+        self._notify(job, None, TimeoutError(f"Reading the receipt took longer than {self.timeout:.0f} seconds."))
+
+    def _notify(self, job, items, error):
+        # Hand off so the pool's result thread never waits on Telegram
+        deliver = lambda: self._deliver(job, items, error)
+        try:
+            if self.run_in_chat is not None:
+                self.run_in_chat(job.key, deliver)
+            else:
+                self._callbacks.submit(deliver)
+        except RuntimeError:
+            pass  # Shutting down
+
+    def _deliver(self, job, items, error):
+        with self._lock:
+            if self._delivering.get(job.key) is job:
+                del self._delivering[job.key]
+            if job.cancelled:
+                return
+        try:
+            job.on_done(items, error)
+        except Exception as e:
+            logging.error(f"OCR completion handler failed for {job.key}: {e}")
+
+    def cancel(self, key):
+        """Drop the job for key. A job already being read finishes in the background but is not reported."""
+        with self._lock:
+            job = self._jobs.get(key)
+            delivering = self._delivering.pop(key, None)
+            if delivering is not None:
+                # Read already, but on_done has not run; it must not run after the cancel
+                delivering.cancelled = True
+        if job is None or not self._settle(job):
+            return delivering is not None
+        job.future.cancel()
+        return True
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            executor, self._executor = self._executor, None
+        for job in jobs:
+            self.cancel(job.key)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._callbacks.shutdown(wait=False)
+
+
+ocr_service = OCRService()
@@ -1,13 +1,14 @@
 # bot/receipthandlersnlp.py
 
-import requests
-import uuid
-import os
 import logging
 from telebot import types
-from classes import User, Group, Expense
+from classes import User, Group
 from client import supa  # Assuming you have a supabase client
 from collections import defaultdict
+from utils import download_receipt_photo, receipt_cache_key, resolve_receipt_tags, save_receipt_expense
+from cache import receipt_items_cache
+from nlpclient import API_URL, NLPUnavailable, nlp_client
+from ocr import ocr_service, OCRQueueFull
 import re
 
 # State management dictionaries for NLP-based receipt processing
@@ -17,10 +18,6 @@ pending_receipt_uploads_nlp = {}
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 
-# Load environment variables for security
-API_URL = os.getenv("NLP_API_URL", "https://c8wgwo8w0c8swww08oo088kg.deploy.jensenhshoots.com/parse-receipt/")
-API_KEY = os.getenv("NLP_API_KEY", "your-default-secure-api-key")  # Replace with your actual API key
-
 def clean_number(value):
     """
     Clean a number string by removing currency symbols and standardizing decimal separators.
@@ -52,6 +49,85 @@ def clean_number(value):
         return float(match.group(1))
     return 0.0
 
+def request_receipt_data(image_bytes: bytes):
+    """
+    Send a receipt image to the NLP API and return its receipt_data, raising if no line items were found.
+
+    Raises NLPUnavailable if the API is degraded, so the caller can fall back to local OCR.
+    """
+    response_data = nlp_client.parse(image_bytes)
+    receipt_data = response_data.get('receipt_data', {})
+    if not receipt_data.get('line_items', []):
+        raise Exception("No items found in the receipt.")
+    return receipt_data
+
+def extract_receipt_items(receipt_data):
+    """
+    Clean the NLP API's receipt_data in place and return its line items as
+    dictionaries with 'item_name', 'amount' and 'item_quantity'.
+    """
+    line_items = receipt_data.get('line_items', [])
+
+    # Handle duplicate subtotal
+    subtotal_raw = receipt_data.get('subtotal', '')
+    subtotal = clean_number(subtotal_raw)
+    tax = clean_number(receipt_data.get('tax', '0.00'))
+
+    total_raw = receipt_data.get('total', '')
+    if not total_raw.strip():
+        # Calculate total as subtotal + tax
+        total = subtotal + tax
+    else:
+        total = clean_number(total_raw)
+
+    # Update receipt_data with cleaned values
+    receipt_data['subtotal'] = subtotal
+    receipt_data['total'] = total
+
+    # Update line items to match expected format
+    items = []
+    for item in line_items:
+        # Skip items with missing or invalid values
+        item_value = item.get('item_value', '')
+        if not item_value or not item.get('item_name', '').strip():
+            continue
+
+        # Clean the item value and validate it's a positive number
+        cleaned_value = clean_number(item_value)
+        if cleaned_value <= 0:
+            continue
+
+        # Get quantity with proper default and validation
+        try:
+            quantity = int(item.get('item_quantity', '1') or '1')
+            if quantity <= 0:
+                quantity = 1
+        except (ValueError, TypeError):
+            quantity = 1
+
+        items.append({
+            "item_name": item.get('item_name', '').strip(),
+            "amount": cleaned_value,
+            "item_quantity": quantity
+        })
+
+    # Verify we have at least one valid item
+    if not items:
+        raise Exception("No valid items found in the receipt.")
+
+    receipt_data['items'] = items
+    return items
+
+def ocr_items_to_nlp_items(ocr_items):
+    """Convert items from the local OCR parser to the NLP pipeline's item format."""
+    return [
+        {
+            "item_name": item['item'],
+            "amount": item['amount'],
+            "item_quantity": 1
+        } for item in ocr_items
+    ]
+
 def register_receipt_handlers_nlp(bot):
     """
     Registers the NLP-based receipt handlers with the bot.
@@ -92,129 +168,89 @@ def register_receipt_handlers_nlp(bot):
             bot.send_message(chat_id, "You are not part of any group. Create or join a group first.")
             return
 
-        # Download the photo
-        file_id = message.photo[-1].file_id
+        # Download the photo into memory
         try:
-            file_info = bot.get_file(file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
+            downloaded_file = download_receipt_photo(bot, message)
+        except ValueError as e:
+            bot.send_message(chat_id, str(e))
+            return
         except Exception as e:
             bot.send_message(chat_id, f"Failed to download the image: {str(e)}")
             logging.error(f"Failed to download image from chat {chat_id}: {str(e)}")
             return
 
-        # Save the image with a unique filename
-        receipt_filename = f"receipt_nlp_{uuid.uuid4()}.jpg"
-        try:
-            with open(receipt_filename, 'wb') as f:
-                f.write(downloaded_file)
-            logging.info(f"Image saved as {receipt_filename} for chat {chat_id}.")
-        except Exception as e:
-            bot.send_message(chat_id, f"Failed to save the image: {str(e)}")
-            logging.error(f"Failed to save image for chat {chat_id}: {str(e)}")
+        def show_items(items):
+            # Store the parsed items in the current_receipts_nlp state
+            current_receipts_nlp[chat_id]['items'] = items
+            current_receipts_nlp[chat_id]['group_id'] = group.group_id
+            current_receipts_nlp[chat_id]['paid_by'] = user_id  # Telegram user_id
+
+            # Format the items for user confirmation
+            formatted_items = "\n".join([f"{i+1}. {item['item_name']} - ${item['amount']}" for i, item in enumerate(items)])
+            markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+            markup.add('Proceed to Tag', 'Cancel')
+
+            # Remove chat from pending uploads
+            pending_receipt_uploads_nlp.pop(chat_id, None)
+
+            # Send confirmation message to the user
+            bot.send_message(chat_id, f"Here are the items I found:\n{formatted_items}\n\nWhat would you like to do next?", reply_markup=markup)
+
+        def fall_back_to_ocr():
+            ocr_cache_key = receipt_cache_key("ocr", downloaded_file)
+            ocr_items = receipt_items_cache.get(ocr_cache_key)
+            if ocr_items is not None:
+                show_items(ocr_items_to_nlp_items(ocr_items))
+                return
+
+            def on_ocr_done(ocr_items, error):
+                # Runs in the chat's update order once the receipt has been read
+                if error is not None:
+                    bot.send_message(chat_id, f"Failed to process receipt: {str(error)}")
+                    logging.error(f"Fallback OCR failed for chat {chat_id}: {str(error)}")
+                    return
+                receipt_items_cache.set(ocr_cache_key, [dict(item) for item in ocr_items])
+                show_items(ocr_items_to_nlp_items(ocr_items))
+
+            bot.send_message(chat_id, "The receipt reader is unavailable, so I'm using basic text recognition instead. Processing your receipt…")
+            try:
+                ocr_service.submit(chat_id, downloaded_file, on_ocr_done)
+            except OCRQueueFull as e:
+                bot.send_message(chat_id, str(e))
+
+        # A re-uploaded photo reuses the items parsed the first time
+        cache_key = receipt_cache_key("nlp", downloaded_file)
+        items = receipt_items_cache.get(cache_key)
+        if items is not None:
+            logging.info(f"Reusing cached receipt items for chat {chat_id}")
+            show_items([dict(item) for item in items])
             return
 
-        # Send the image to the new NLP-based API
+        # Send the image bytes to the new NLP-based API
         try:
-            headers = {
-                "x-api-key": API_KEY
-            }
-            files = {
-                "file": open(receipt_filename, 'rb')
-            }
-            logging.info(f"Sending image {receipt_filename} to NLP API at {API_URL}...")
-            response = requests.post(API_URL, headers=headers, files=files)
-            if response.status_code != 200:
-                raise Exception(f"API returned status code {response.status_code}: {response.text}")
-            response_data = response.json()
-            receipt_data = response_data.get('receipt_data', {})
-            line_items = receipt_data.get('line_items', [])
-            if not line_items:
-                raise Exception("No items found in the receipt.")
+            logging.info(f"Sending {len(downloaded_file)} byte image from chat {chat_id} to NLP API at {API_URL}...")
+            receipt_data = request_receipt_data(downloaded_file)
             logging.info(f"API parsed receipt data for chat {chat_id}: {receipt_data}")
+        except NLPUnavailable as e:
+            logging.warning(f"NLP API unavailable for chat {chat_id}, falling back to OCR: {str(e)}")
+            fall_back_to_ocr()
+            return
         except Exception as e:
             bot.send_message(chat_id, f"Failed to process receipt via NLP API: {str(e)}")
             logging.error(f"NLP API processing failed for chat {chat_id}: {str(e)}")
-            os.remove(receipt_filename)
             return
 
-        # Cleanup the temporary image file
-        try:
-            os.remove(receipt_filename)
-            logging.info(f"Temporary file {receipt_filename} deleted.")
-        except Exception as e:
-            logging.warning(f"Failed to delete temporary file {receipt_filename}: {str(e)}")
-
         # Post-process receipt data
         try:
-            # Handle duplicate subtotal
-            subtotal_raw = receipt_data.get('subtotal', '')
-            subtotal = clean_number(subtotal_raw)
-            tax = clean_number(receipt_data.get('tax', '0.00'))
-            
-            total_raw = receipt_data.get('total', '')
-            if not total_raw.strip():
-                # Calculate total as subtotal + tax
-                total = subtotal + tax
-            else:
-                total = clean_number(total_raw)
-
-            # Update receipt_data with cleaned values
-            receipt_data['subtotal'] = subtotal
-            receipt_data['total'] = total
-
-            # Update line items to match expected format
-            items = []
-            for item in line_items:
-                # Skip items with missing or invalid values
-                item_value = item.get('item_value', '')
-                if not item_value or not item.get('item_name', '').strip():
-                    continue
-
-                # Clean the item value and validate it's a positive number
-                cleaned_value = clean_number(item_value)
-                if cleaned_value <= 0:
-                    continue
-
-                # Get quantity with proper default and validation
-                try:
-                    quantity = int(item.get('item_quantity', '1') or '1')
-                    if quantity <= 0:
-                        quantity = 1
-                except (ValueError, TypeError):
-                    quantity = 1
-
-                items.append({
-                    "item_name": item.get('item_name', '').strip(),
-                    "amount": cleaned_value,
-                    "item_quantity": quantity
-                })
-
-            # Verify we have at least one valid item
-            if not items:
-                raise Exception("No valid items found in the receipt.")
-                
-            receipt_data['items'] = items
+            items = extract_receipt_items(receipt_data)
             logging.info(f"Post-processed receipt data for chat {chat_id}: {receipt_data}")
         except Exception as e:
             bot.send_message(chat_id, f"Failed to process receipt data: {str(e)}")
             logging.error(f"Post-processing failed for chat {chat_id}: {str(e)}")
             return
+        receipt_items_cache.set(cache_key, [dict(item) for item in items])
 
-        # Store the parsed items in the current_receipts_nlp state
-        current_receipts_nlp[chat_id]['items'] = receipt_data['items']
-        current_receipts_nlp[chat_id]['group_id'] = group.group_id
-        current_receipts_nlp[chat_id]['paid_by'] = user_id  # Telegram user_id
-
-        # Format the items for user confirmation
-        formatted_items = "\n".join([f"{i+1}. {item['item_name']} - ${item['amount']}" for i, item in enumerate(receipt_data['items'])])
-        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        markup.add('Proceed to Tag', 'Cancel')
-
-        # Remove chat from pending uploads
-        pending_receipt_uploads_nlp.pop(chat_id, None)
-
-        # Send confirmation message to the user
-        bot.send_message(chat_id, f"Here are the items I found:\n{formatted_items}\n\nWhat would you like to do next?", reply_markup=markup)
+        show_items(items)
 
     @bot.message_handler(func=lambda message: message.text == 'Proceed to Tag')
     def proceed_to_tag_nlp(message):
@@ -233,6 +269,7 @@ def register_receipt_handlers_nlp(bot):
         Handles the 'Cancel' action.
         """
         chat_id = message.chat.id
+        ocr_service.cancel(chat_id)
         if chat_id in current_receipts_nlp:
             del current_receipts_nlp[chat_id]
         bot.send_message(chat_id, "Receipt processing has been canceled.", reply_markup=types.ReplyKeyboardRemove())
@@ -260,105 +297,37 @@ def register_receipt_handlers_nlp(bot):
             return
 
         # Fetch group and current items
-        group_id = current_receipts_nlp[chat_id]['group_id']
         group = Group.fetch_from_db_by_chat(chat_id)
         items = current_receipts_nlp[chat_id]['items']
         paid_by_telegram_id = current_receipts_nlp[chat_id]['paid_by']
 
-        # Fetch the payer User object
-        payer_user = User.fetch_from_db_by_user_id(paid_by_telegram_id)
+        # Resolve the payer and every tagged username from one roster fetch
+        roster = group.fetch_roster()
+        payer_user = roster.by_user_id.get(paid_by_telegram_id) or User.fetch_from_db_by_user_id(paid_by_telegram_id)
         if not payer_user:
             bot.send_message(chat_id, "Payer user not found in the database.")
             return
 
-        # Initialize a list to keep track of tagged users
-        tagged_users = []
-
-        for match in matches:
-            username, item_number = match
-            try:
-                item_index = int(item_number) - 1
-                if item_index < 0 or item_index >= len(items):
-                    bot.send_message(chat_id, f"Item number {item_number} is out of range.")
-                    continue
-            except ValueError:
-                bot.send_message(chat_id, f"Invalid item number: {item_number}")
-                continue
-
-            # Fetch the user by username
-            tagged_user = User.fetch_from_db_by_username(username)
-            if not tagged_user:
-                bot.send_message(chat_id, f"User @{username} not found in the database.")
-                continue
-
-            # Check if the tagged user is part of the group
-            if not group.check_user_in_group(tagged_user):
-                bot.send_message(chat_id, f"User @{username} is not a member of this group.")
-                continue
-
-            # Append to tagged_users list
-            tagged_users.append((tagged_user, items[item_index]))
+        tagged_users, errors = resolve_receipt_tags(group, items, matches)
+        if errors:
+            bot.send_message(chat_id, "\n".join(errors))
 
         if not tagged_users:
             bot.send_message(chat_id, "No valid tags were found. Please try again.")
             return
 
-        # Create a new Expense entry
-        expense_description = "Receipt Import (NLP)"
-        total_amount = sum([item['amount'] for item in items])
-        expense = Expense(group=group, paid_by=payer_user, amount=total_amount, description=expense_description)
         try:
-            expense.save_to_db()
+            save_receipt_expense(group, payer_user, items, tagged_users, "Receipt Import (NLP)")
         except Exception as e:
             bot.send_message(chat_id, f"Failed to save expense: {str(e)}")
-            logging.error(f"Failed to save expense for chat {chat_id}: {str(e)}")
+            logging.error(f"Failed to save receipt expense for chat {chat_id}: {str(e)}")
             return
 
-        # Prepare bulk operations
-        splits_to_add = []
-        debt_updates = []
-
-        # Process all tags in memory first
-        for tagged_user, item in tagged_users:
-            # Prepare split data
-            split_data = {
-                "expense_id": expense.expense_id,
-                "user_id": tagged_user.uuid,
-                "amount": item['amount']
-            }
-            splits_to_add.append(split_data)
-
-            # Prepare debt updates
-            debt_details = {
-                "group_id": group.group_id,
-                "user_id": tagged_user.uuid,
-                "opp_user_id": payer_user.uuid,
-                "increment_value": item['amount']
-            }
-            reverse_debt_details = {
-                "group_id": group.group_id,
-                "user_id": payer_user.uuid,
-                "opp_user_id": tagged_user.uuid,
-                "increment_value": -item['amount']
-            }
-            debt_updates.append(debt_details)
-            debt_updates.append(reverse_debt_details)
-
-        # Execute bulk operations
-        try:
-            if splits_to_add:
-                Expense.add_splits_bulk(splits_to_add)
-            if debt_updates:
-                Expense.add_debts_bulk(debt_updates)
-                
-            # Send success messages
-            for tagged_user, item in tagged_users:
-                bot.send_message(chat_id, f"Tagged @{tagged_user.username} to '{item['item_name']}' (${item['amount']})")
-        except Exception as e:
-            bot.send_message(chat_id, f"Failed to process tags: {str(e)}")
-            logging.error(f"Failed to process tags for chat {chat_id}: {str(e)}")
+        tag_lines = "\n".join(
+            f"@{tagged_user.username}: '{item['item_name']}' (${item['amount']})" for tagged_user, item in tagged_users
+        )
 
         # Clear the current receipt processing state
         del current_receipts_nlp[chat_id]
 
-        bot.send_message(chat_id, "Receipt processing complete and debts updated.", reply_markup=types.ReplyKeyboardRemove())
\ No newline at end of file
+        bot.send_message(chat_id, f"Tagged items:\n{tag_lines}\n\nReceipt processing complete and debts updated.", reply_markup=types.ReplyKeyboardRemove())
\ No newline at end of file
@@ -0,0 +1,141 @@
+# bot/receiptimage.py
+
+import os
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+# Preprocessing runs in the OCR worker processes, so like ocr.py this module must not import classes or client
+
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "true").lower() == "true"
+# Receipts are downscaled so that a receipt of OCR_RECEIPT_WIDTH_MM fills OCR_TARGET_DPI; larger photos only cost OCR time
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", 300))
+OCR_RECEIPT_WIDTH_MM = float(os.getenv("OCR_RECEIPT_WIDTH_MM", 80))
+# Adaptive threshold: a pixel is ink if it is more than OFFSET darker than the mean of its RADIUS neighbourhood
+OCR_THRESHOLD_RADIUS = int(os.getenv("OCR_THRESHOLD_RADIUS", 15))
+OCR_THRESHOLD_OFFSET = int(os.getenv("OCR_THRESHOLD_OFFSET", 10))
+# Skew is searched within +/- OCR_DESKEW_MAX_ANGLE degrees in OCR_DESKEW_STEP steps; 0 disables deskewing
+OCR_DESKEW_MAX_ANGLE = float(os.getenv("OCR_DESKEW_MAX_ANGLE", 10))
+OCR_DESKEW_STEP = float(os.getenv("OCR_DESKEW_STEP", 0.5))
+# White border, in pixels, kept around the content after cropping
+OCR_CROP_MARGIN = int(os.getenv("OCR_CROP_MARGIN", 20))
+
+# Width of the thumbnail the skew angle is estimated on
+DESKEW_SAMPLE_WIDTH = 400
+# Small receipts are enlarged to the target width, but by no more than this, since upscaling adds no detail
+MAX_UPSCALE = 3
+
+MM_PER_INCH = 25.4
+
+
+def target_width(dpi: int = OCR_TARGET_DPI, receipt_width_mm: float = OCR_RECEIPT_WIDTH_MM):
+    return round(dpi * receipt_width_mm / MM_PER_INCH)
+
+
+def downscale(image, max_width: int):
+    """Shrink image to max_width pixels wide, keeping its aspect ratio. Smaller images are left alone."""
+    if image.width <= max_width:
+        return image
+    height = max(1, round(image.height * max_width / image.width))
+    return image.resize((max_width, height), Image.LANCZOS)
+
+
+def scale_to_width(image, width: int, max_upscale: float = MAX_UPSCALE):
+    """Resize image to width pixels wide, keeping its aspect ratio, enlarging by at most max_upscale."""
+    width = min(width, round(image.width * max_upscale))
+    if image.width == width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def adaptive_threshold(gray, radius: int = OCR_THRESHOLD_RADIUS, offset: int = OCR_THRESHOLD_OFFSET):
+    """
+    Binarise a grayscale image against its local mean, which copes with shadows and uneven
+    lighting that defeat a single global threshold. Ink is 0, paper is 255.
+    """
+    local_mean = gray.filter(ImageFilter.BoxBlur(radius))
+    # Positive where the pixel is darker than its neighbourhood, clipped to 0 elsewhere
+    darkness = ImageChops.subtract(local_mean, gray)
+    return darkness.point(lambda value: 0 if value > offset else 255)
+
+
+def _row_profile_score(binary):
+    # Text lines aligned with the rows give sharply alternating row means, i.e. a high variance
+    rows = list(binary.resize((1, binary.height), Image.BOX).getdata())
+    mean = sum(rows) / len(rows)
+    return sum((row - mean) ** 2 for row in rows)
+
+
+def estimate_skew(binary, max_angle: float = OCR_DESKEW_MAX_ANGLE, step: float = OCR_DESKEW_STEP):
+    """Return the rotation in degrees that best aligns the text lines of a binarised image with the rows."""
+    if max_angle <= 0 or step <= 0:
+        return 0.0
+    sample = downscale(binary, DESKEW_SAMPLE_WIDTH)
+    best_angle, best_score = 0.0, None
+    steps = int(max_angle / step)
+    for i in range(-steps, steps + 1):
+        angle = i * step
+        rotated = sample.rotate(angle, resample=Image.NEAREST, expand=True, fillcolor=255)
+        score = _row_profile_score(rotated)
+        if best_score is None or score > best_score:
+            best_angle, best_score = angle, score
+    return best_angle
+
+
+def crop_to_content(binary, margin: int = OCR_CROP_MARGIN):
+    """Crop a binarised image to the bounding box of its ink plus margin pixels."""
+    bbox = ImageOps.invert(binary).getbbox()
+    if bbox is None:
+        return binary
+    left, top, right, bottom = bbox
+    return binary.crop((
+        max(0, left - margin),
+        max(0, top - margin),
+        min(binary.width, right + margin),
+        min(binary.height, bottom + margin),
+    ))
+
+
+def find_content_box(gray, sample_width: int, threshold_radius: int = OCR_THRESHOLD_RADIUS,
+                     threshold_offset: int = OCR_THRESHOLD_OFFSET, margin: int = OCR_CROP_MARGIN):
+    """
+    Locate the printed area of a grayscale photo, returning its box in the photo's own pixels.
+
+    The ink is found on a copy sample_width pixels wide, so the full photo is never thresholded.
+    """
+    sample = downscale(gray, sample_width)
+    bbox = ImageOps.invert(adaptive_threshold(sample, threshold_radius, threshold_offset)).getbbox()
+    if bbox is None:
+        return None
+    scale = gray.width / sample.width
+    left, top, right, bottom = bbox
+    return (
+        max(0, round((left - margin) * scale)),
+        max(0, round((top - margin) * scale)),
+        min(gray.width, round((right + margin) * scale)),
+        min(gray.height, round((bottom + margin) * scale)),
+    )
+
+
+def preprocess_receipt(image, dpi: int = OCR_TARGET_DPI, receipt_width_mm: float = OCR_RECEIPT_WIDTH_MM,
+                       threshold_radius: int = OCR_THRESHOLD_RADIUS, threshold_offset: int = OCR_THRESHOLD_OFFSET,
+                       deskew_max_angle: float = OCR_DESKEW_MAX_ANGLE, deskew_step: float = OCR_DESKEW_STEP,
+                       crop_margin: int = OCR_CROP_MARGIN):
+    """
+    Prepare a receipt photo for Tesseract: upright, grayscale, cropped to the printed area,
+    scaled so that area is the target DPI wide, adaptively thresholded and deskewed.
+
+    Cropping comes before scaling, so a receipt that fills only part of the frame still
+    reaches the target resolution instead of shrinking with the rest of the photo.
+    """
+    image = ImageOps.exif_transpose(image)  # Phone photos are often stored sideways with an orientation tag
+    gray = image.convert("L")
+    width = target_width(dpi, receipt_width_mm)
+    box = find_content_box(gray, width, threshold_radius, threshold_offset, crop_margin)
+    if box is not None:
+        gray = gray.crop(box)
+    gray = scale_to_width(gray, width)
+    binary = adaptive_threshold(gray, threshold_radius, threshold_offset)
+    angle = estimate_skew(binary, deskew_max_angle, deskew_step)
+    if angle:
+        binary = binary.rotate(angle, resample=Image.NEAREST, expand=True, fillcolor=255)
+    return crop_to_content(binary, crop_margin)
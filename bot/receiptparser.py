@@ -0,0 +1,110 @@
+# bot/receiptparser.py
+
+import re
+import logging
+
+# Lines mentioning any of these are totals, taxes or receipt metadata rather than items
+EXCLUDE_RE = re.compile(
+    r'\b(?:subtotal|tax|total|change|refund|discount|thank you|purchase date|date|balance due'
+    r'|guests|pax|reprint|server|service charge|fees|gst)\b',
+    re.IGNORECASE,
+)
+
+# "4.50", "$4.50", "1,234.56", "1.234,56", "1234.56", "12". The lookbehind keeps an amount from
+# starting in the middle of a number, so "1,234.56" is never read as a name ending "1,23" and "4.56".
+AMOUNT = r'(?<![\d.,])\$?(?:\d{1,3}(?:[.,]\d{3})+|\d+)(?:[.,]\d{2})?'
+# Unit prices always carry cents, so a bare number before the total stays part of the item name
+UNIT_PRICE = r'(?<![\d.,])\$?(?:\d{1,3}(?:[.,]\d{3})+|\d+)[.,]\d{2}'
+# Dot leaders, dash or "=" before the line total, or just whitespace
+SEPARATOR = r'(?:\s*[.\-=:]+\s*|\s+)'
+
+ITEM_LINE_RE = re.compile(rf'''
+    ^
+    (?:\d{{1,3}}\s*[xX]?\s+)?                           # leading quantity: "2 Latte", "2x Latte"
+    (?P<name>[^\W\d_].*?)?                              # item name; absent on a quantity line below its item
+    (?:
+        \s*[xX]\s*\d{{1,3}}                             # trailing quantity: "Latte x2"
+      | \s+\d{{1,3}}(?=\s*[xX@]|\s+{AMOUNT}\s+{AMOUNT}$)  # quantity column: "Latte 2 @ 4.50", "Latte  2  4.50  9.00"
+    )?
+    (?:\s*[xX@]?\s*(?P<unit_price>{UNIT_PRICE})(?:\s*each)?{SEPARATOR})?  # unit price column, always separated from the total
+    {SEPARATOR}?
+    (?P<price>{AMOUNT})
+    $
+''', re.VERBOSE)
+
+TRAILING_PUNCTUATION_RE = re.compile(r'[.\-:\s]+$')
+CENTS_RE = re.compile(r'[.,]\d{2}$')
+
+
+def parse_amount(text: str):
+    """Parse a receipt amount, treating the last separator before exactly two digits as the decimal point."""
+    digits = text.lstrip('$')
+    if len(digits) > 3 and digits[-3] in '.,':
+        whole, cents = digits[:-3], digits[-2:]
+    else:
+        whole, cents = digits, '00'
+    return float(f"{re.sub(r'[.,]', '', whole) or '0'}.{cents}")
+
+
+def parse_receipt_text(text):
+    """
+    Parses the OCR-extracted text to identify items and their corresponding amounts.
+
+    Each line is checked against one exclusion pattern and matched once against one
+    item pattern. Lines may carry quantity, unit price and line total columns, in
+    which case the line total is used. A line holding only a quantity, unit price or
+    total is joined to the item name on the line above it.
+
+    Args:
+        text (str): Text extracted from the receipt.
+
+    Returns:
+        list: A list of dictionaries containing 'item' and 'amount'.
+
+    Raises:
+        Exception: If no valid items are found.
+    """
+    items = []
+    pending_name = None  # A name-only line waiting for its amounts on the next line
+
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue  # Skip empty lines
+
+        if EXCLUDE_RE.search(line):
+            logging.debug(f"Excluded line: {line}")
+            pending_name = None
+            continue  # Skip non-item lines
+
+        match = ITEM_LINE_RE.match(line)
+        if not match:
+            # Possibly an item name whose amounts are printed on the following line
+            pending_name = line if line[0].isalpha() else None
+            logging.debug(f"No pattern matched for line: {line}")
+            continue
+
+        item_name = match.group('name')
+        if item_name is None:
+            # Only amounts with cents are joined to the name above, so stray numbers such as
+            # table or receipt numbers under the shop name are not mistaken for items
+            has_cents = match.group('unit_price') or CENTS_RE.search(match.group('price'))
+            item_name = pending_name if has_cents else None
+        pending_name = None
+        if not item_name:
+            continue
+
+        # Clean item name: remove trailing dots, hyphens, and extra spaces
+        item_name = TRAILING_PUNCTUATION_RE.sub('', item_name)
+        amount = parse_amount(match.group('price'))
+        if amount <= 0:
+            logging.debug(f"Skipped invalid amount in line: {line}")
+            continue
+
+        items.append({'item': item_name, 'amount': amount})
+        logging.debug(f"Matched line: {line} -> Item: {item_name}, Amount: {amount}")
+
+    if not items:
+        raise Exception("No valid items with positive amounts were found.")
+
+    return items
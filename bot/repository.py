@@ -0,0 +1,144 @@
+# bot/repository.py
+
+import asyncio
+import logging
+import threading
+import httpx
+from client import SUPABASE_URL, SUPABASE_KEY
+
+
+class AsyncRepository:
+    """
+    Async read access to the Supabase REST API over pooled HTTP/2 keep-alive connections.
+
+    Every coroutine runs on one dedicated event loop thread that owns the HTTP
+    client, so synchronous telebot handlers can use it with run(), or start several
+    reads at once with submit() and collect their futures together.
+    """
+
+    def __init__(self, url: str, key: str, max_connections: int = 20, max_keepalive_connections: int = 10,
+                 keepalive_expiry: float = 30.0, timeout: float = 10.0):
+        self._base_url = f"{url.rstrip('/')}/rest/v1"
+        self._headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+        }
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._timeout = timeout
+        self._client = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="repository-loop", daemon=True).start()
+        return self._loop
+
+    def _http(self):
+        # Only ever called on the repository loop, which the client is bound to
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self._base_url,
+                headers=self._headers,
+                http2=True,
+                limits=self._limits,
+                timeout=self._timeout,
+            )
+        return self._client
+
+    def submit(self, coro):
+        """Schedule a repository coroutine and return a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro):
+        """Run a repository coroutine to completion from synchronous code."""
+        return self.submit(coro).result()
+
+    async def _close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def close(self):
+        """Close pooled connections and stop the repository loop."""
+        if self._loop is None:
+            return
+        try:
+            self.run(self._close())
+        except Exception as e:
+            logging.warning(f"Failed to close repository client: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+    async def _select(self, table: str, params: dict):
+        response = await self._http().get(f"/{table}", params={"select": "*", **params})
+        response.raise_for_status()
+        return response.json()
+
+    async def _select_all(self, table: str, params: dict, order: str, page_size: int = 1000):
+        # PostgREST caps each response, so page through with a stable order
+        rows = []
+        offset = 0
+        while True:
+            page = await self._select(table, {**params, "order": order, "limit": page_size, "offset": offset})
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+            offset += page_size
+
+    async def _rpc(self, name: str, payload: dict):
+        response = await self._http().post(f"/rpc/{name}", json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    async def fetch_group_members(self, group_id: str):
+        """Fetch the users table rows of every member of a group."""
+        return await self._rpc("get_group_members", {"group_id_param": group_id})
+
+    async def fetch_debts_by_group(self, group_id: str):
+        """Fetch all rows of the debts table for a group."""
+        return await self._select_all("debts", {"group_id": f"eq.{group_id}"}, order="user_id,opp_user_id")
+
+    async def fetch_expenses_by_group(self, group_id: str):
+        """Fetch all rows of the expenses table for a group."""
+        return await self._select_all("expenses", {"group_id": f"eq.{group_id}"}, order="created_at,expense_id")
+
+    async def fetch_settlements_by_group(self, group_id: str):
+        """Fetch all rows of the settlements table for a group."""
+        return await self._select_all("settlements", {"group_id": f"eq.{group_id}"}, order="created_at,settlement_id")
+
+    async def fetch_balances_by_group(self, group_id: str):
+        """Fetch the balances ledger rows for a group."""
+        return await self._select_all("balances", {"group_id": f"eq.{group_id}"}, order="user_id")
+
+    async def fetch_reminder_chunk(self, group_ids: list, use_ledger: bool = False):
+        """
+        Fetch the balance rows and members of several groups concurrently.
+
+        Balance rows are debts rows, or balances ledger rows if use_ledger is set.
+        Member rows are group_members rows with the member's users row embedded under "users".
+        """
+        in_filter = f"in.({','.join(group_ids)})"
+        if use_ledger:
+            balance_rows = self._select_all("balances", {"group_id": in_filter}, order="group_id,user_id")
+        else:
+            balance_rows = self._select_all("debts", {"group_id": in_filter}, order="group_id,user_id,opp_user_id")
+        member_rows = self._select_all(
+            "group_members",
+            {"select": "group_id,users(*)", "group_id": in_filter},
+            order="group_id,user_uuid",
+        )
+        return await asyncio.gather(balance_rows, member_rows)
+
+    async def fetch_reminder_deliveries(self, run_id: str):
+        """Fetch the reminder_deliveries rows recorded for a reminder run."""
+        return await self._select_all("reminder_deliveries", {"select": "chat_id", "run_id": f"eq.{run_id}"}, order="chat_id")
+
+
+repo = AsyncRepository(SUPABASE_URL, SUPABASE_KEY)
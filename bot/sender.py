@@ -0,0 +1,166 @@
+# bot/sender.py
+
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from telebot.apihelper import ApiTelegramException
+
+# How often idle per-chat buckets are dropped
+CHAT_BUCKET_SWEEP_SECONDS = float(os.getenv("CHAT_BUCKET_SWEEP_SECONDS", 60))
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at rate tokens per second, holding at most capacity tokens."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available and any pause has passed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                    self._updated_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the next seconds, e.g. for a retry_after from Telegram."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # One send is allowed when the pause ends, not a burst saved up during it
+            self._tokens = min(self.capacity, 1)
+            self._updated_at = self._paused_until
+
+    def is_idle(self):
+        """True if the bucket is full and not paused, so it behaves exactly like a new one."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return False
+            return self._tokens + (now - self._updated_at) * self.rate >= self.capacity
+
+
+class ReminderSender:
+    """
+    Send messages to many chats concurrently while staying inside Telegram's flood limits.
+
+    A global bucket caps messages per second across all chats and a bucket per chat
+    caps messages per minute to any one group. A 429 pauses both buckets for the
+    retry_after Telegram asks for, so every thread holds off, not just the one that
+    got it; the per-chat buckets should keep us under the per-chat limit, so a 429
+    usually means the bot's overall limit was hit. Server errors and network failures
+    are retried with jittered exponential backoff. Other API errors, such as the bot
+    having been removed from the chat, fail immediately.
+
+    Per-chat buckets that have refilled are dropped every CHAT_BUCKET_SWEEP_SECONDS,
+    so the table only holds chats messaged recently.
+    """
+
+    def __init__(self, bot, global_per_second: float = 25, chat_per_minute: float = 20, max_workers: int = 8,
+                 max_retries: int = 3, backoff_base: float = 0.5):
+        self.bot = bot
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.chat_per_minute = chat_per_minute
+        self._global_bucket = TokenBucket(global_per_second, capacity=global_per_second)
+        self._chat_buckets = {}
+        self._swept_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._swept_at >= CHAT_BUCKET_SWEEP_SECONDS:
+                self._swept_at = now
+                idle = [key for key, bucket in self._chat_buckets.items() if bucket.is_idle()]
+                for key in idle:
+                    del self._chat_buckets[key]
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_per_minute / 60)
+            return bucket
+
+    def send(self, chat_id, text: str, **kwargs):
+        """Send one message with rate limiting and retries, returning a result dict for the chat."""
+        attempts = 0
+        while True:
+            attempts += 1
+            self._chat_bucket(chat_id).acquire()
+            self._global_bucket.acquire()
+            try:
+                self.bot.send_message(chat_id, text, **kwargs)
+                return {"chat_id": chat_id, "status": "sent", "attempts": attempts}
+            except ApiTelegramException as e:
+                error = e
+                if e.error_code == 429:
+                    delay = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                    self._chat_bucket(chat_id).pause(delay)
+                    self._global_bucket.pause(delay)
+                elif e.error_code >= 500:
+                    delay = self._backoff(attempts)
+                else:
+                    return {"chat_id": chat_id, "status": "failed", "attempts": attempts, "error": str(e)}
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                delay = self._backoff(attempts)
+
+            if attempts > self.max_retries:
+                return {"chat_id": chat_id, "status": "failed", "attempts": attempts, "error": str(error)}
+            logging.warning(f"Retrying message to chat {chat_id} in {delay:.2f}s after: {error}")
+            time.sleep(delay)
+
+    def _backoff(self, attempts: int):
+        # Full jitter keeps retries from many chats from lining up
+        return random.uniform(0, self.backoff_base * 2 ** (attempts - 1))
+
+    def send_all(self, messages, on_sent=None, **kwargs):
+        """
+        Send (chat_id, text) pairs concurrently and return one result dict per chat.
+
+        messages may be a generator; sending starts as soon as the first pair arrives.
+        on_sent, if given, is called with the chat_id of each delivered message as soon
+        as it is delivered.
+        """
+        # Bound the number of queued sends so a large generator is not drained into memory up front
+        slots = threading.BoundedSemaphore(self.max_workers * 2)
+
+        def send_and_release(chat_id, text):
+            try:
+                result = self.send(chat_id, text, **kwargs)
+                if on_sent and result["status"] == "sent":
+                    try:
+                        on_sent(chat_id)
+                    except Exception as e:
+                        # The message is out either way; a missed checkpoint only risks a repeat on resume
+                        logging.error(f"on_sent callback failed for chat {chat_id}: {e}")
+                return result
+            except Exception as e:
+                return {"chat_id": chat_id, "status": "failed", "attempts": 1, "error": str(e)}
+            finally:
+                slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="reminder-sender") as executor:
+            for chat_id, text in messages:
+                slots.acquire()
+                futures.append(executor.submit(send_and_release, chat_id, text))
+        return [future.result() for future in futures]
@@ -1,61 +1,103 @@
-from classes import Group, User, Expense
+from classes import Group, GroupRoster, User, Expense
+from money import MAX_AMOUNT_CENTS, to_cents, db_to_cents, from_cents, format_cents, split_evenly
+from debtsimplifier import default_simplifier
+from ledger import BALANCE_LEDGER_ENABLED
+from repository import repo
+from cache import debt_snapshot_cache
+from collections import defaultdict
+import hashlib
+import logging
+import os
 import re
 
-def is_group_chat(message):
-    """Check if the message is from a group chat"""
-    return message.chat.type in ['group', 'supergroup']
-
-def simplify_debts(balances):
-        """Simplify debts by finding who owes what to whom."""
-        creditors = []
-        debtors = []
-
-        # Split users into creditors (positive balance) and debtors (negative balance)
-        for user_id, balance in balances.items():
-            if balance > 0:
-                creditors.append((user_id, balance))  # Users who are owed money
-            elif balance < 0:
-                debtors.append((user_id, -balance))  # Users who owe money
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, calculate_user_balances falls back to pure Python
+    np = None
 
-        # Sort creditors and debtors by their balances
-        creditors.sort(key=lambda x: x[1], reverse=True)  # Sort by amount owed, descending
-        debtors.sort(key=lambda x: x[1], reverse=True)  # Sort by amount owed, descending
+# Below this many debt rows the pure-Python loop beats numpy's setup cost (see bench/bench_balances.py)
+NUMPY_BALANCES_MIN_ROWS = 2000
 
-        simplified_debts = []
-        while creditors and debtors:
-            creditor_id, credit_amount = creditors.pop()
-            debtor_id, debt_amount = debtors.pop()
+# Largest receipt photo the bot will download and hold in memory
+RECEIPT_MAX_BYTES = int(os.getenv("RECEIPT_MAX_BYTES", 10 * 1024 * 1024))
 
-            # Calculate the minimum of what the debtor owes and what the creditor is owed
-            amount = min(credit_amount, debt_amount)
+# Groups per batched query in the reminder pipeline, small enough to keep the in.(...) filter URL short
+REMINDER_CHUNK_SIZE = int(os.getenv("REMINDER_CHUNK_SIZE", 100))
 
-            # Record this transaction
-            if amount >= 0.01:           
-                simplified_debts.append((debtor_id, creditor_id, amount))
-
-            # Adjust the remaining balances
-            credit_amount -= amount
-            debt_amount -= amount
-
-            # If there's remaining debt, push the debtor back
-            if debt_amount > 0:
-                debtors.append((debtor_id, debt_amount))
+def is_group_chat(message):
+    """Check if the message is from a group chat"""
+    return message.chat.type in ['group', 'supergroup']
 
-            # If there's remaining credit, push the creditor back
-            if credit_amount > 0:
-                creditors.append((creditor_id, credit_amount))
+def download_receipt_photo(bot, message):
+    """
+    Download the largest size of a photo message into memory and return its bytes.
+
+    Raises ValueError if the photo is larger than RECEIPT_MAX_BYTES, checking the
+    size Telegram reports before downloading and the actual size after.
+    """
+    photo = message.photo[-1]
+    if photo.file_size and photo.file_size > RECEIPT_MAX_BYTES:
+        raise ValueError(f"The image is too large. Please send a photo under {RECEIPT_MAX_BYTES // (1024 * 1024)} MB.")
+    file_info = bot.get_file(photo.file_id)
+    downloaded_file = bot.download_file(file_info.file_path)
+    if len(downloaded_file) > RECEIPT_MAX_BYTES:
+        raise ValueError(f"The image is too large. Please send a photo under {RECEIPT_MAX_BYTES // (1024 * 1024)} MB.")
+    return downloaded_file
+
+def receipt_cache_key(pipeline: str, image_bytes: bytes):
+    """Key parsed receipt items by pipeline and a hash of the image, so an identical re-upload skips parsing."""
+    return pipeline, hashlib.sha256(image_bytes).hexdigest()
+
+def simplify_debts(balances, simplifier=None):
+        """
+        Simplify debts by finding who owes what to whom. Balances and amounts are in integer cents.
 
-        return simplified_debts
+        Uses the automatic strategy from debtsimplifier unless another simplifier is given.
+        """
+        return (simplifier or default_simplifier).simplify(balances)
 
 def calculate_user_balances(debts):
-        """Calculate the net balances for each user based on expense splits."""
+        """Calculate the net balances for each user, in integer cents, based on expense splits."""
+        if np is not None and len(debts) >= NUMPY_BALANCES_MIN_ROWS:
+            return calculate_user_balances_numpy(debts)
+        return calculate_user_balances_python(debts)
+
+def calculate_user_balances_numpy(debts):
+        """Vectorised calculate_user_balances: map uuids to dense indices once, then net with bincount."""
+        index = {}  # uuid -> dense index, in first-seen order
+        count = len(debts)
+        debtor_idx = np.fromiter((index.setdefault(debt['user_id'], len(index)) for debt in debts), dtype=np.intp, count=count)
+        creditor_idx = np.fromiter((index.setdefault(debt['opp_user_id'], len(index)) for debt in debts), dtype=np.intp, count=count)
+        # amount_owed is DECIMAL(10, 2), so rounding dollars * 100 recovers the exact cents
+        amounts = np.rint(np.fromiter((debt['amount_owed'] for debt in debts), dtype=np.float64, count=count) * 100)
+
+        # Only consider debts where amount_owed > 0 (ignore the reverse row where the amount is negative)
+        positive = amounts > 0
+        debtor_idx = debtor_idx[positive]
+        creditor_idx = creditor_idx[positive]
+        amounts = amounts[positive]
+
+        size = len(index)
+        # Integer-valued float64 sums are exact far beyond the 10^8 dollar cap
+        net = np.bincount(creditor_idx, weights=amounts, minlength=size) - np.bincount(debtor_idx, weights=amounts, minlength=size)
+        net = np.rint(net).astype(np.int64)
+
+        involved = np.zeros(size, dtype=bool)
+        involved[debtor_idx] = True
+        involved[creditor_idx] = True
+
+        uuids = list(index)
+        return {uuids[i]: int(net[i]) for i in np.flatnonzero(involved)}
+
+def calculate_user_balances_python(debts):
+        """Pure-Python calculate_user_balances, used when numpy is unavailable or the input is small."""
         balances = {}
 
         # Process each split, but only handle the "positive" direction (one-way) to avoid double counting
         for debt in debts:
             user_id = debt['user_id']
             opp_user_id = debt['opp_user_id']
-            amount_owed = debt['amount_owed']
+            amount_owed = db_to_cents(debt['amount_owed'])
 
             # Only consider debts where amount_owed > 0 (ignore the reverse row where the amount is negative)
             if amount_owed > 0:
@@ -92,10 +134,10 @@ def process_add_expense(group: Group, user: User, input_text: str):
         if len(lines) < 2:
             raise Exception("Please follow the format given!")
 
-        # Parse the expense name and total amount
+        # Parse the expense name and total amount, working in integer cents from here on
         expense_name = lines[0]
         try:
-            expense_amount = float(lines[1])
+            expense_amount = to_cents(lines[1])
         except ValueError:
             raise ValueError(f"Please key in a valid number for expense amount!")
 
@@ -103,7 +145,7 @@ def process_add_expense(group: Group, user: User, input_text: str):
             raise ValueError(f"Expense amount must be more than 0!")
 
         # Ensure the expense amount is within the allowed range
-        if expense_amount >= 10**8:
+        if expense_amount >= MAX_AMOUNT_CENTS:
             raise ValueError(f"Expense amount must be less than {10**8}.")
 
         # Step 2: Parse tagged users and their amounts
@@ -111,7 +153,7 @@ def process_add_expense(group: Group, user: User, input_text: str):
         tagged_without_amount = []
         total_tagged_amount = 0
 
-        group_members_username_dict = Group.fetch_group_members_usernames_dict(group)
+        group_members_username_dict = group.fetch_roster().by_username
 
         tagged_users_so_far = []
 
@@ -126,9 +168,9 @@ def process_add_expense(group: Group, user: User, input_text: str):
             if match_with_amount:
                 # User with a specific amount
                 username = match_with_amount.group(1)
-                amount = float(match_with_amount.group(2))
+                amount = to_cents(match_with_amount.group(2))
                 # Ensure the amount is within the allowed range
-                if amount >= 10**8:
+                if amount >= MAX_AMOUNT_CENTS:
                     raise ValueError(f"Tagged amount must be less than {10**8}.")
                 tagged_user = group_members_username_dict.get(username)
                 if tagged_user:
@@ -152,24 +194,20 @@ def process_add_expense(group: Group, user: User, input_text: str):
                 tagged_users_so_far.append(tagged_user)
 
         if total_tagged_amount > expense_amount:
-            raise ValueError(f"Total tagged amount ${total_tagged_amount:.2f} exceeds the expense amount ${expense_amount:.2f}.")
+            raise ValueError(f"Total tagged amount ${format_cents(total_tagged_amount)} exceeds the expense amount ${format_cents(expense_amount)}.")
 
 
         # Step 3: Calculate the remaining amount to be split among users with no specific amount
         remaining_amount = expense_amount - total_tagged_amount
 
         if tagged_without_amount:
-            split_amount_per_user = remaining_amount / (len(tagged_without_amount) + 1)
+            # The payer takes the first share, so any leftover cent is absorbed by the payer first
+            payer_share, *split_amounts = split_evenly(remaining_amount, len(tagged_without_amount) + 1)
         else:
-            split_amount_per_user = 0
-
-        # Ensure the split amount per user is within the allowed range
-        if split_amount_per_user >= 10**8:
-            raise ValueError(f"Split amount per user must be less than {10**8}.")
+            split_amounts = []
 
-        # Step 4: Create the expense entry in the database
-        expense = Expense(group=group, paid_by=user, amount=expense_amount, description=expense_name)
-        expense.save_to_db()
+        # Step 4: Create the expense, which is written together with its splits and debts in Step 7
+        expense = Expense(group=group, paid_by=user, amount=from_cents(expense_amount), description=expense_name)
 
         debt_updates = []
         splits_to_add = []
@@ -180,14 +218,14 @@ def process_add_expense(group: Group, user: User, input_text: str):
                 "group_id": expense.group.group_id,
                 "user_id": tagged_user.uuid,
                 "opp_user_id": expense.paid_by.uuid,
-                "increment_value": amount
+                "increment_value": from_cents(amount)
             }
 
             reverse_debt_details = {
                 "group_id": expense.group.group_id,
                 "user_id": expense.paid_by.uuid,
                 "opp_user_id": tagged_user.uuid,
-                "increment_value": -amount
+                "increment_value": -from_cents(amount)
             }
 
             debt_updates.append(debt_details)
@@ -196,26 +234,26 @@ def process_add_expense(group: Group, user: User, input_text: str):
             split_details = {
                 "user_id" : tagged_user.uuid,
                 "expense_id": expense.expense_id,
-                "amount": amount
+                "amount": from_cents(amount)
             }
 
             splits_to_add.append(split_details)
             
 
         # Step 6: Update expense splits for users tagged without specific amounts (split the remaining amount)
-        for tagged_user in tagged_without_amount:
+        for tagged_user, split_amount in zip(tagged_without_amount, split_amounts):
             debt_details = {
                 "group_id": expense.group.group_id,
                 "user_id": tagged_user.uuid,
                 "opp_user_id": expense.paid_by.uuid,
-                "increment_value": split_amount_per_user
+                "increment_value": from_cents(split_amount)
             }
 
             reverse_debt_details = {
                 "group_id": expense.group.group_id,
                 "user_id": expense.paid_by.uuid,
                 "opp_user_id": tagged_user.uuid,
-                "increment_value": -split_amount_per_user
+                "increment_value": -from_cents(split_amount)
             }
 
             debt_updates.append(debt_details)
@@ -224,63 +262,190 @@ def process_add_expense(group: Group, user: User, input_text: str):
             split_details = {
                 "user_id" : tagged_user.uuid,
                 "expense_id": expense.expense_id,
-                "amount": split_amount_per_user
+                "amount": from_cents(split_amount)
             }
 
             splits_to_add.append(split_details)
-            
-        if debt_updates:
-            Expense.add_debts_bulk(debt_updates)
 
-        if splits_to_add:
-            Expense.add_splits_bulk(splits_to_add)
+        # Step 7: Save the expense, splits and debts in one transaction
+        expense.commit(splits_to_add, debt_updates)
 
         print("Expense processing complete.")
 
-def get_display_debts_string(debts, group):
+def resolve_receipt_tags(group: Group, items, matches):
+    """
+    Resolve (username, item_number) tag pairs against the group's roster with one member fetch.
+
+    Returns:
+        tuple: A list of (User, item) pairs for valid tags and a list of error messages for the rest.
+    """
+    group_members_username_dict = group.fetch_roster().by_username
+    tagged_users = []
+    errors = []
+
+    for username, item_number in matches:
+        item_index = int(item_number) - 1
+        if item_index < 0 or item_index >= len(items):
+            errors.append(f"Item number {item_number} is out of range.")
+            continue
+
+        tagged_user = group_members_username_dict.get(username)
+        if not tagged_user:
+            errors.append(f"User @{username} is not a member of this group.")
+            continue
+
+        tagged_users.append((tagged_user, items[item_index]))
+
+    return tagged_users, errors
+
+def save_receipt_expense(group: Group, payer: User, items, tagged_users, description: str):
+    """
+    Record a receipt as one expense paid by payer and split by the tagged items.
+
+    Each user's tagged items are totalled in cents first, so the whole receipt is
+    saved by one Expense.commit call however many items were tagged.
+
+    Returns:
+        Expense: The saved expense.
+    """
+    total_amount = sum(to_cents(item['amount']) for item in items)
+    user_totals = defaultdict(int)  # uuid -> cents
+    for tagged_user, item in tagged_users:
+        user_totals[tagged_user.uuid] += to_cents(item['amount'])
+
+    expense = Expense(group=group, paid_by=payer, amount=from_cents(total_amount), description=description)
+
+    splits_to_add = []
+    debt_updates = []
+
+    for user_uuid, amount in user_totals.items():
+        # Like the payer's share in /add_expense, items tagged to the payer are neither split nor owed
+        if user_uuid == payer.uuid:
+            continue
+
+        splits_to_add.append({
+            "user_id": user_uuid,
+            "expense_id": expense.expense_id,
+            "amount": from_cents(amount)
+        })
+        debt_updates.append({
+            "group_id": group.group_id,
+            "user_id": user_uuid,
+            "opp_user_id": payer.uuid,
+            "increment_value": from_cents(amount)
+        })
+        debt_updates.append({
+            "group_id": group.group_id,
+            "user_id": payer.uuid,
+            "opp_user_id": user_uuid,
+            "increment_value": -from_cents(amount)
+        })
+
+    expense.commit(splits_to_add, debt_updates)
+
+    return expense
+
+def get_display_debts_string(debts, group, roster=None):
     """Format and display simplified debts in the group."""
     debt_messages = []
 
-    group_members_dict = Group.fetch_group_members_dict(group)
+    group_members_dict = (roster or group.fetch_roster()).by_uuid
 
     for debtor_id, creditor_id, amount in debts:
         debtor = group_members_dict[debtor_id]
         creditor = group_members_dict[creditor_id]
-        debt_messages.append(f"{debtor.username} owes {creditor.username} ${amount:.2f}")
+        debt_messages.append(f"{debtor.username} owes {creditor.username} ${format_cents(amount)}")
 
     return "\n".join(debt_messages)
 
-def get_display_debts_string_with_at(debts, group):
+def get_display_debts_string_with_at(debts, group, roster=None):
     """Format and display simplified debts in the group."""
     debt_messages = []
 
-    group_members_dict = Group.fetch_group_members_dict(group)
+    group_members_dict = (roster or group.fetch_roster()).by_uuid
 
     for debtor_id, creditor_id, amount in debts:
         debtor = group_members_dict[debtor_id]
         creditor = group_members_dict[creditor_id]
-        debt_messages.append(f"@{debtor.username} owes @{creditor.username} ${amount:.2f}")
+        debt_messages.append(f"@{debtor.username} owes @{creditor.username} ${format_cents(amount)}")
 
     debt_messages.reverse()
     return "\n".join(debt_messages)
 
-def process_reminders():
+def build_debt_snapshot(group, user_balances, roster=None):
+    """Simplify and render a group's balances, returning (balances, simplified_debts, rendered_string)."""
+    simplified_debts = simplify_debts(user_balances) if user_balances else []
+    rendered_string = get_display_debts_string_with_at(simplified_debts, group, roster) if simplified_debts else ""
+    return user_balances, simplified_debts, rendered_string
+
+def cached_debt_snapshot(group):
+    """Return the cached snapshot for the group's current version, or None."""
+    if group.version is None:
+        return None
+    return debt_snapshot_cache.get((group.group_id, group.version))
+
+def store_debt_snapshot(group, snapshot):
+    if group.version is not None:
+        debt_snapshot_cache.set((group.group_id, group.version), snapshot)
+
+def iter_reminders(chunk_size: int = REMINDER_CHUNK_SIZE):
+    """
+    Yield (chat_id, display_debts_string) for every reminder-enabled group with outstanding debts.
+
+    Groups whose version has a cached snapshot are answered from it without
+    touching the database. Debts and members of the rest are fetched for
+    chunk_size groups at a time with two concurrent queries, and the next chunk
+    is fetched while the current one is being computed, so results stream out
+    as soon as their chunk arrives.
+    """
     groups = Group.get_groups_with_reminders_on()
+    if len(groups) > debt_snapshot_cache.maxsize:
+        logging.warning(f"{len(groups)} reminder groups exceed DEBT_SNAPSHOT_MAX_ENTRIES ({debt_snapshot_cache.maxsize}), so snapshots will not be reused")
+    chunks = [groups[i:i + chunk_size] for i in range(0, len(groups), chunk_size)]
+
+    def fetch(chunk):
+        snapshots = {}
+        for group in chunk:
+            snapshot = cached_debt_snapshot(group)
+            if snapshot is not None:
+                snapshots[group.group_id] = snapshot
+        stale_ids = [group.group_id for group in chunk if group.group_id not in snapshots]
+        if not stale_ids:
+            return snapshots, None
+        return snapshots, repo.submit(repo.fetch_reminder_chunk(stale_ids, BALANCE_LEDGER_ENABLED))
+
+    pending = fetch(chunks[0]) if chunks else None
+    for index, chunk in enumerate(chunks):
+        snapshots, rows_future = pending
+        balance_rows, member_rows = rows_future.result() if rows_future else ([], [])
+        if index + 1 < len(chunks):
+            pending = fetch(chunks[index + 1])
+
+        rows_by_group = defaultdict(list)
+        for row in balance_rows:
+            rows_by_group[row['group_id']].append(row)
+        members_by_group = defaultdict(list)
+        for row in member_rows:
+            members_by_group[row['group_id']].append(row['users'])
+
+        for group in chunk:
+            snapshot = snapshots.get(group.group_id)
+            if snapshot is None:
+                rows = rows_by_group.get(group.group_id, [])
+                if BALANCE_LEDGER_ENABLED:
+                    user_balances = {row['user_id']: db_to_cents(row['balance']) for row in rows}
+                else:
+                    user_balances = calculate_user_balances(rows) if rows else {}
+                roster = GroupRoster.from_rows(members_by_group[group.group_id])
+                snapshot = build_debt_snapshot(group, user_balances, roster)
+                store_debt_snapshot(group, snapshot)
+            _, _, rendered_string = snapshot
+            if rendered_string:
+                yield group.chat_id, rendered_string
 
-    chat_id_to_display_debts_string = {}
-
-    if groups:
-        for group in groups:
-            debts = group.fetch_debts_by_group()
-            if debts:
-                user_balances = calculate_user_balances(debts)
-                simplified_debts = simplify_debts(user_balances)
-                chat_id = group.chat_id
-                if simplified_debts:
-                    display_debts_string = get_display_debts_string_with_at(simplified_debts, group)
-                    chat_id_to_display_debts_string[chat_id] = display_debts_string
-    
-    return chat_id_to_display_debts_string
+def process_reminders():
+    """Return {chat_id: display_debts_string} for every reminder-enabled group with outstanding debts."""
+    return dict(iter_reminders())
 
 def remove_underscore_markdown(text: str) -> str:
     """Escape Markdown special characters in a string."""
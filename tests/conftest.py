@@ -0,0 +1,9 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# Bot modules import each other by bare name, as they do when run from the bot directory
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "bot"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
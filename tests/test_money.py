@@ -0,0 +1,31 @@
+# tests/test_money.py
+
+import random
+import pytest
+from money import db_to_cents, format_cents, split_evenly, to_cents
+
+
+@pytest.mark.parametrize("value, cents", [
+    ("12.34", 1234), ("0.005", 1), (" 7 ", 700), (12.34, 1234), (0.1 + 0.2, 30), ("-1.50", -150),
+])
+def test_to_cents(value, cents):
+    assert to_cents(value) == cents
+
+
+@pytest.mark.parametrize("value", ["abc", "", "nan", "inf", "1e30", 1e300])
+def test_to_cents_rejects_with_value_error(value):
+    with pytest.raises(ValueError):
+        to_cents(value)
+
+
+def test_db_to_cents_matches_to_cents_for_decimal_10_2():
+    rng = random.Random(1)
+    for _ in range(100000):
+        cents = rng.randint(-10**10 + 1, 10**10 - 1)
+        dollars = float(format_cents(cents))  # As PostgREST returns a DECIMAL(10, 2) value
+        assert db_to_cents(dollars) == to_cents(dollars) == cents
+
+
+def test_split_evenly_sums_to_total():
+    assert split_evenly(1000, 3) == [334, 333, 333]
+    assert sum(split_evenly(99999, 7)) == 99999
@@ -0,0 +1,51 @@
+# tests/test_receiptparser.py
+
+import pytest
+from receipt_corpus import generate_corpus, score
+from receiptparser import parse_amount, parse_receipt_text
+
+
+@pytest.mark.parametrize("line, item, amount", [
+    ("Kaya Toast    3.20", "Kaya Toast", 3.20),
+    ("Kaya Toast ....... 3.20", "Kaya Toast", 3.20),
+    ("Kaya Toast - 3.20", "Kaya Toast", 3.20),
+    ("Kaya Toast x2 6.40", "Kaya Toast", 6.40),
+    ("Kaya Toast 2 @ 3.20 each = 6.40", "Kaya Toast", 6.40),
+    ("Kaya Toast   2   3.20   6.40", "Kaya Toast", 6.40),
+    ("2 x Kaya Toast   $6.40", "Kaya Toast", 6.40),
+    ("Big Item 1,234.56", "Big Item", 1234.56),
+    ("Big Item 1.234,56", "Big Item", 1234.56),
+    ("Big Item 1234.56", "Big Item", 1234.56),
+    ("Coke 330ml 2.50", "Coke 330ml", 2.50),
+])
+def test_item_line(line, item, amount):
+    assert parse_receipt_text(line) == [{'item': item, 'amount': amount}]
+
+
+def test_quantity_line_joins_name_above():
+    assert parse_receipt_text("Kaya Toast\n  2 x 3.20      6.40") == [{'item': 'Kaya Toast', 'amount': 6.40}]
+
+
+def test_stray_number_is_not_joined_to_name_above():
+    # A table number under the shop name has no cents, so it is not an item
+    with pytest.raises(Exception):
+        parse_receipt_text("KOPITIAM PTE LTD\n12")
+
+
+def test_totals_and_metadata_are_excluded():
+    text = "Latte 4.50\nSUBTOTAL 4.50\nGST 9% 0.41\nTOTAL 4.91\nDate: 12/03/2024\nThank you!"
+    assert parse_receipt_text(text) == [{'item': 'Latte', 'amount': 4.50}]
+
+
+@pytest.mark.parametrize("text, amount", [
+    ("4.50", 4.50), ("$4.50", 4.50), ("12", 12.0), ("1,234.56", 1234.56), ("1.234,56", 1234.56), ("1,234", 1234.0),
+])
+def test_parse_amount(text, amount):
+    assert parse_amount(text) == amount
+
+
+def test_corpus_accuracy():
+    accuracy, by_layout = score(parse_receipt_text, generate_corpus(200))
+    assert accuracy >= 0.95
+    # Every layout but quantity lines, where an item name ending in a number is ambiguous, must parse exactly
+    assert all(layout_accuracy == 1.0 for layout, layout_accuracy in by_layout.items() if layout != "quantity_line")
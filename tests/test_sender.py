@@ -0,0 +1,106 @@
+# tests/test_sender.py
+
+import threading
+import time
+import sender
+from sender import ReminderSender, TokenBucket
+from telebot.apihelper import ApiTelegramException
+
+
+def telegram_error(code, description, retry_after=None):
+    result_json = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        result_json["parameters"] = {"retry_after": retry_after}
+    return ApiTelegramException("sendMessage", None, result_json)
+
+
+class FakeTelegram:
+    """Stands in for telebot.TeleBot, recording sends and raising queued errors per chat."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}  # chat_id -> [exception, ...] raised by the next sends to it
+        self.sent = []  # (chat_id, text, monotonic time)
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            queued = self.errors.get(chat_id)
+            if queued:
+                raise queued.pop(0)
+            self.sent.append((chat_id, text, time.monotonic()))
+
+
+def test_sends_every_message():
+    bot = FakeTelegram()
+    results = ReminderSender(bot, global_per_second=1000, chat_per_minute=6000).send_all((i, f"hi {i}") for i in range(50))
+    assert [result["status"] for result in results] == ["sent"] * 50
+    assert sorted(chat_id for chat_id, _, _ in bot.sent) == list(range(50))
+
+
+def test_chat_bucket_spaces_messages_to_one_chat():
+    bot = FakeTelegram()
+    reminder_sender = ReminderSender(bot, global_per_second=1000, chat_per_minute=600)  # one every 0.1 s
+    reminder_sender.send_all([(1, "a"), (1, "b"), (1, "c")])
+    times = sorted(sent_at for _, _, sent_at in bot.sent)
+    assert times[2] - times[0] >= 0.18
+
+
+def send_during_retry_after(chat_id):
+    """Hit a 429 on chat 1, then send to chat_id from another thread while the retry_after runs."""
+    bot = FakeTelegram({1: [telegram_error(429, "Too Many Requests", retry_after=0.5)]})
+    reminder_sender = ReminderSender(bot, global_per_second=1000, chat_per_minute=60000)
+    started = time.monotonic()
+    first = threading.Thread(target=reminder_sender.send, args=(1, "a"))
+    first.start()
+    time.sleep(0.1)
+    result = reminder_sender.send(chat_id, "b")
+    first.join()
+    sent_at = next(sent_at for sent_chat_id, text, sent_at in bot.sent if text == "b")
+    return result, sent_at - started
+
+
+def test_retry_after_holds_every_sender_to_the_chat():
+    result, waited = send_during_retry_after(1)
+    assert result["status"] == "sent" and result["attempts"] == 1
+    assert waited >= 0.45
+
+
+def test_retry_after_holds_other_chats():
+    result, waited = send_during_retry_after(2)
+    assert result["status"] == "sent"
+    assert waited >= 0.45
+
+
+def test_server_errors_are_retried_and_client_errors_are_not():
+    bot = FakeTelegram({
+        1: [telegram_error(502, "Bad Gateway")],
+        2: [telegram_error(403, "Forbidden: bot was kicked from the group chat")],
+    })
+    reminder_sender = ReminderSender(bot, global_per_second=1000, chat_per_minute=60000, backoff_base=0.01)
+    results = {result["chat_id"]: result for result in reminder_sender.send_all([(1, "a"), (2, "b")])}
+    assert results[1]["status"] == "sent" and results[1]["attempts"] == 2
+    assert results[2]["status"] == "failed" and results[2]["attempts"] == 1
+
+
+def test_gives_up_after_max_retries():
+    bot = FakeTelegram({1: [telegram_error(500, "Internal Server Error")] * 5})
+    result = ReminderSender(bot, chat_per_minute=60000, max_retries=2, backoff_base=0.01).send(1, "a")
+    assert result["status"] == "failed" and result["attempts"] == 3
+
+
+def test_idle_chat_buckets_are_evicted(monkeypatch):
+    monkeypatch.setattr(sender, "CHAT_BUCKET_SWEEP_SECONDS", 0)
+    reminder_sender = ReminderSender(FakeTelegram(), global_per_second=1000, chat_per_minute=60000)
+    for chat_id in range(100):
+        reminder_sender.send(chat_id, "hi")
+    time.sleep(0.01)  # every bucket refills at 1000 tokens per second
+    reminder_sender.send(-1, "hi")
+    assert list(reminder_sender._chat_buckets) == [-1]
+
+
+def test_paused_bucket_is_not_idle():
+    bucket = TokenBucket(rate=1000)
+    bucket.pause(0.2)
+    assert not bucket.is_idle()
+    time.sleep(0.25)
+    assert bucket.is_idle()